@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the fc_update.py forecast archive.
+
+A synthetic year of windguru runs, one every few hours, is appended to a
+scratch archive for a few spots. Append latency and the latency of a one
+month range scan (reading one column of every row) are measured during the
+first and the last month, they should stay flat as the archive grows. Then
+the archive is compacted and expired as if the year had passed, and the
+time and the bytes kept are reported. The report is JSON.
+"""
+
+import sys, os, json, time, random, shutil, tempfile
+import argparse, statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import fc_update
+
+START_TM = 1483228800 # 2017-01-01 UTC
+MONTH = 30*24*60*60
+
+def get_run(issued_tm, steps, rnd):
+    valid_times = [ issued_tm + hour*60*60 for hour in range(0, steps*3, 3) ]
+    columns = dict([ (name, [ rnd.uniform(0, 30) for _ in range(steps) ]) for name in fc_update.WG_COLUMNS ])
+
+    return valid_times, columns
+
+def get_stats(samples):
+    samples = sorted(samples)
+
+    return {
+        "runs": len(samples),
+        "mean_ms": statistics.mean(samples) * 1000,
+        "p50_ms": samples[int(0.50 * (len(samples) - 1))] * 1000,
+        "p95_ms": samples[int(0.95 * (len(samples) - 1))] * 1000,
+    }
+
+def time_query(archive, sites, end_tm, iterations):
+    """ Scan the month before end_tm for every site, reading every wave height """
+    samples = []
+
+    for _ in range(iterations):
+        for site in sites:
+            start_tm = time.perf_counter()
+            total = 0.0
+
+            for chunk in archive.query(site, fc_update.KEY_WG, end_tm - MONTH, end_tm, names=("HTSGW",)):
+                total += sum(chunk.columns["HTSGW"])
+
+            samples.append(time.perf_counter() - start_tm)
+
+    return samples
+
+def get_size(dirname):
+    return sum([ os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(dirname) for name in names ])
+
+def bench_archive(days, interval, sites, steps, iterations):
+    report = {}
+    workdir = tempfile.mkdtemp(prefix="fc_archive.")
+    archive = fc_update.ForecastArchive(workdir)
+    sites = [ "site%d" % (idx) for idx in range(sites) ]
+    rnd = random.Random(0)
+    runs = days*24*60*60 // interval
+    month_runs = MONTH // interval
+    appends = []
+
+    try:
+        for idx in range(runs):
+            issued_tm = START_TM + idx*interval
+
+            for site in sites:
+                valid_times, columns = get_run(issued_tm, steps, rnd)
+                start_tm = time.perf_counter()
+                archive.append(site, fc_update.KEY_WG, issued_tm, valid_times, columns)
+                appends.append(time.perf_counter() - start_tm)
+
+            if idx + 1 == month_runs:
+                report["query_first_month"] = get_stats(time_query(archive, sites, issued_tm + 1, iterations))
+
+        end_tm = START_TM + runs*interval
+        report["query_last_month"] = get_stats(time_query(archive, sites, end_tm, iterations))
+        report["append_first_month"] = get_stats(appends[:month_runs * len(sites)])
+        report["append_last_month"] = get_stats(appends[-month_runs * len(sites):])
+        report["bytes"] = get_size(workdir)
+
+        start_tm = time.perf_counter()
+        compacted, _ = archive.maintain(now=end_tm)
+        report["compact"] = { "seconds": time.perf_counter() - start_tm, "series": compacted,
+                              "bytes": get_size(workdir) }
+
+        start_tm = time.perf_counter()
+        _, deleted = archive.maintain(now=end_tm + fc_update.ARCHIVE_RETENTION - 6*MONTH)
+        report["expire"] = { "seconds": time.perf_counter() - start_tm, "partitions": deleted,
+                             "bytes": get_size(workdir) }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark appends, range scans and upkeep of the forecast archive.")
+    parser.add_argument("-d", "--days", type=int, default=365, help="days of runs to append")
+    parser.add_argument("-i", "--interval", type=int, default=3*60*60, help="seconds between runs")
+    parser.add_argument("-s", "--sites", type=int, default=3, help="spots appended per run")
+    parser.add_argument("--steps", type=int, default=81, help="forecast steps per run")
+    parser.add_argument("-n", "--iterations", type=int, default=20, help="range scans per site and case")
+    parser.add_argument("-o", "--output", default="", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = bench_archive(args.days, args.interval, args.sites, args.steps, args.iterations)
+    txt = json.dumps(report, indent=1)
+
+    if args.output:
+        with open(args.output, "w") as fd:
+            fd.write(txt + "\n")
+    else:
+        print(txt)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+Startup benchmark of fc_update.py.
+
+Every sample is a fresh interpreter: `import fc_update` alone, and a
+--render-only run against an empty store in a scratch directory. The cost of
+each module fc_update imports comes from `python -X importtime`. The report
+is JSON; the run fails if a render-only run loads the network stack, or if a
+p50 is more than --tolerance above the saved baseline (-u saves one, it is
+specific to the host it was taken on).
+"""
+
+import sys, os, json, time, shutil, tempfile, subprocess
+import argparse, statistics
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baseline.json")
+
+# must not be loaded by a render-only run
+NETWORK_MODULES = ("requests", "bs4", "urllib3", "asyncio", "concurrent.futures")
+
+IMPORT_CODE = "import fc_update"
+
+RENDER_CODE = r'''
+import sys, json
+import fc_update
+fc_update.DB_NAME = sys.argv[1]
+sys.argv = [ "fc_update.py", "-R", "-w", sys.argv[2] ]
+fc_update.main()
+print(json.dumps([ name for name in %r if name in sys.modules ]))
+''' % (NETWORK_MODULES,)
+
+def run_python(args, workdir):
+    start_tm = time.perf_counter()
+    proc = subprocess.run([ sys.executable ] + args, cwd=workdir, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    return time.perf_counter() - start_tm, proc
+
+def get_import_costs():
+    """ {module: cumulative microseconds} of the modules fc_update imports directly """
+    _, proc = run_python([ "-X", "importtime", "-c", IMPORT_CODE ], ROOT_DIR)
+    costs = {}
+
+    # children are listed before their parent, two more spaces per nesting level
+    for line in proc.stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+
+        _, cumulative, name = fields
+        level = (len(name) - len(name.lstrip(" ")) - 1) // 2
+
+        if level == 1:
+            costs[name.strip()] = int(cumulative)
+        elif level == 0 and name.strip() == "fc_update":
+            return costs
+        elif level == 0:
+            costs = {}
+
+    return costs
+
+def get_stats(samples):
+    samples = sorted(samples)
+
+    return {
+        "runs": len(samples),
+        "mean": statistics.mean(samples),
+        "p50": samples[int(0.50 * (len(samples) - 1))],
+        "p95": samples[int(0.95 * (len(samples) - 1))],
+        "max": samples[-1],
+    }
+
+def bench_startup(iterations):
+    report = {}
+    workdir = tempfile.mkdtemp(prefix="fc_startup.")
+    db_file = os.path.join(workdir, "db", "forecast.sqlite")
+    www_dir = os.path.join(workdir, "www")
+    render_args = [ "-c", RENDER_CODE, db_file, www_dir ]
+
+    try:
+        os.makedirs(www_dir)
+
+        # the first render writes every page, the timed ones find them unchanged like most runs do
+        _, proc = run_python(render_args, ROOT_DIR)
+        report["network_modules"] = json.loads(proc.stdout.splitlines()[-1])
+
+        report["import"] = get_stats([ run_python([ "-c", IMPORT_CODE ], ROOT_DIR)[0] for _ in range(iterations) ])
+        report["render_only"] = get_stats([ run_python(render_args, ROOT_DIR)[0] for _ in range(iterations) ])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    samples = [ get_import_costs() for _ in range(iterations) ]
+    report["import_costs_us"] = dict([ (name, statistics.median([ costs.get(name, 0) for costs in samples ]))
+                                       for name in sorted(samples[0], key=lambda name: -samples[0][name]) ])
+
+    return report
+
+def check_regressions(report, baseline, tolerance):
+    errors = []
+
+    if report["network_modules"]:
+        errors.append("render-only run imported %s" % (", ".join(report["network_modules"])))
+
+    for case in ("import", "render_only"):
+        if case in baseline and report[case]["p50"] > baseline[case] * (1 + tolerance):
+            errors.append("%s p50 %.1f ms > baseline %.1f ms + %d%%" %
+                          (case, report[case]["p50"] * 1000, baseline[case] * 1000, tolerance * 100))
+
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fc_update.py interpreter startup and imports.")
+    parser.add_argument("-n", "--iterations", type=int, default=10, help="interpreters started per case")
+    parser.add_argument("-b", "--baseline", default=BASELINE_FILE, help="p50 baseline to compare against")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.25,
+                        help="allowed p50 slowdown over the baseline, as a fraction")
+    parser.add_argument("-u", "--update", action="store_true", default=False,
+                        help="save this run's p50s as the baseline")
+    parser.add_argument("-o", "--output", default="", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = bench_startup(args.iterations)
+    txt = json.dumps(report, indent=1)
+
+    if args.output:
+        with open(args.output, "w") as fd:
+            fd.write(txt + "\n")
+    else:
+        print(txt)
+
+    if args.update:
+        with open(args.baseline, "w") as fd:
+            json.dump(dict([ (case, report[case]["p50"]) for case in ("import", "render_only") ]), fd, indent=1)
+            fd.write("\n")
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+
+    errors = check_regressions(report, baseline, args.tolerance)
+
+    for error in errors:
+        print("REGRESSION: %s" % (error), file=sys.stderr)
+
+    sys.exit(1 if errors else 0)
+
+if __name__ == "__main__":
+    main()
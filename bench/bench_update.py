@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark of fc_update.py.
+
+The synthetic pages in fixtures/, written after the markup of the upstream
+sites (see check_parsers.py), are served by a local stand-in server with
+configurable latency and jitter, fc_update is pointed at it, and then
+update_html_files is timed per category and every fetcher's parse path is
+timed in isolation. The report (throughput, p50/p95, peak memory) is JSON;
+throughput is parses/s for the parse cases and sites/s for the updates.
+"""
+
+import sys, os, io, json, time, random, shutil, tempfile, hashlib
+import argparse, logging, threading, statistics, tracemalloc, collections
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import fc_update
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# url substring -> fixture page
+ROUTES = [
+    ("/Tidal30days/", "cwb_tide.htm"),
+    ("/3Hr/", "cwb_3hr.htm"),
+    ("/Tide/", "msw_tide.html"),
+    ("/int/index.php", "windguru.html"),
+    ("/cwm_ljp.gif", "cwm_ljp.gif"),
+]
+
+# upstream site -> path prefix on the stand-in server
+UPSTREAMS = [
+    "http://old.windguru.cz/",
+    "http://www.cwb.gov.tw/",
+    "http://magicseaweed.com/",
+    "http://www.imocwx.com/",
+]
+
+PARSE_CASES = [
+    ("windguru.html", fc_update.WindGuruDataFetcher, "http://old.windguru.cz/int/index.php?sc=174669"),
+    ("cwb_3hr.htm", fc_update.WeatherDataFetcher, "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/1000204.htm"),
+    ("cwb_tide.htm", fc_update.CwbTideDataFetcher, "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/000204.htm"),
+    ("msw_tide.html", fc_update.MswTideDataFetcher, "http://magicseaweed.com/Canggu-Surf-Report/935/Tide/"),
+]
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    jitter = 0.0
+    bodies = {}
+    failing = [] # url substrings answered with 503
+    hits = collections.Counter() # path -> GETs
+
+    def do_GET(self):
+        for pattern, filename in ROUTES:
+            if pattern in self.path:
+                break
+        else:
+            self.send_error(404)
+            return
+
+        self.hits[self.path] += 1
+        time.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        if [ pattern for pattern in self.failing if pattern in self.path ]:
+            self.send_error(503)
+            return
+
+        body = self.bodies[filename]
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer(object):
+    def __init__(self, latency, jitter):
+        StandInHandler.latency = latency
+        StandInHandler.jitter = jitter
+
+        for _, filename in ROUTES:
+            with open(os.path.join(FIXTURE_DIR, filename), "rb") as fd:
+                StandInHandler.bodies[filename] = fd.read()
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.httpd.daemon_threads = True
+        self.base_url = "http://127.0.0.1:%d/" % (self.httpd.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_url(self, url):
+        for idx, upstream in enumerate(UPSTREAMS):
+            if url.startswith(upstream):
+                return "%shost%d/%s" % (self.base_url, idx, url[len(upstream):])
+
+        return url
+
+def redirect_upstreams(server):
+    """ Point every url fc_update knows about at the stand-in server. """
+    for categ, infos in fc_update.INFOS_MAP.items():
+        fc_update.INFOS_MAP[categ] = [ info._replace(wg_url=server.get_url(info.wg_url),
+                                                     tide_url=server.get_url(info.tide_url),
+                                                     weather_url=server.get_url(info.weather_url))
+                                       for info in infos ]
+
+    fc_update.CWB_SITE = server.get_url(fc_update.CWB_SITE)
+    fc_update.MSW_SITE = server.get_url(fc_update.MSW_SITE)
+    fc_update.JP_IMG_URL = server.get_url(fc_update.JP_IMG_URL)
+
+def get_stats(samples, ops=1):
+    samples = sorted(samples)
+
+    return {
+        "runs": len(samples),
+        "throughput": ops * len(samples) / sum(samples) if sum(samples) else 0,
+        "mean": statistics.mean(samples),
+        "p50": samples[int(0.50 * (len(samples) - 1))],
+        "p95": samples[int(0.95 * (len(samples) - 1))],
+        "max": samples[-1],
+    }
+
+def measure(func, iterations, ops=1):
+    samples = []
+
+    for _ in range(iterations):
+        start_tm = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start_tm)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    stats = get_stats(samples, ops)
+    stats["peak_mem"] = peak
+
+    return stats
+
+def bench_parsers(iterations, parser):
+    report = {}
+
+    for filename, fetcher_cls, url in PARSE_CASES:
+        with open(os.path.join(FIXTURE_DIR, filename), "rb") as fd:
+            body = fd.read()
+
+        fetcher = fetcher_cls(url, parser=parser)
+        report[fetcher_cls.__name__] = measure(lambda: fetcher.parse(body), iterations)
+        report[fetcher_cls.__name__]["bytes"] = len(body)
+
+    return report
+
+def bench_updates(iterations, args):
+    report = {}
+    workdir = tempfile.mkdtemp(prefix="fc_bench.")
+    cwd = os.getcwd()
+
+    store = fc_update.ForecastStore(os.path.join(workdir, "db", "forecast.sqlite"))
+    os.chdir(workdir)
+
+    def run(categs):
+        cache = fc_update.ResponseCache(os.path.join(workdir, "cache")) if args.cache else None
+        engine = fc_update.ThreadFetchEngine() if args.engine == fc_update.ENGINE_THREAD else fc_update.AsyncFetchEngine()
+
+        fc_update.update_html_files(categs, cache, fc_update.SessionPool(), engine, args.parser, store=store, force=True,
+                                    parse_workers=args.parse_workers)
+
+    try:
+        for categ in fc_update.SITE_CATEG_ALL:
+            report[categ] = measure(lambda: run([ categ ]), iterations, len(fc_update.INFOS_MAP[categ]))
+
+        report["all"] = measure(lambda: run(fc_update.SITE_CATEG_ALL), iterations,
+                                sum([ len(infos) for infos in fc_update.INFOS_MAP.values() ]))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fc_update.py against the fixture pages.")
+    parser.add_argument("-n", "--iterations", type=int, default=5, help="timed runs per case")
+    parser.add_argument("-l", "--latency", type=float, default=0.05, help="stand-in server latency in seconds")
+    parser.add_argument("-j", "--jitter", type=float, default=0.02, help="+/- latency jitter in seconds")
+    parser.add_argument("-e", "--engine", default=fc_update.ENGINE_ASYNCIO, choices=fc_update.ENGINE_ALL)
+    parser.add_argument("-P", "--parser", default=fc_update.PARSER_AUTO, choices=fc_update.PARSER_ALL)
+    parser.add_argument("-J", "--parse-workers", type=int, default=fc_update.PARSE_WORKERS,
+                        help="parse processes of the update runs, 1 parses in the fetch threads")
+    parser.add_argument("-c", "--cache", action="store_true", default=False,
+                        help="keep the http response cache between runs")
+    parser.add_argument("-o", "--output", default="", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    report = {
+        "args": vars(args),
+        "parser_backend": fc_update.get_parser_backend(args.parser),
+        "cpus": os.cpu_count(),
+        "parse": bench_parsers(args.iterations * 10, args.parser),
+    }
+
+    with StandInServer(args.latency, args.jitter) as server:
+        redirect_upstreams(server)
+        report["update"] = bench_updates(args.iterations, args)
+
+    content = json.dumps(report, indent=2)
+
+    if args.output:
+        with io.open(args.output, "w", encoding='utf-8') as fd:
+            fd.write(content + "\n")
+    else:
+        print(content)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Check that the daemon (-D) does not hammer an upstream that keeps failing.
+
+The daemon runs against the stand-in server of bench_update.py, with the
+MSW tide pages answering 503 to every GET. Its first scheduled run fetches
+every fragment and fails the MSW tides; within SCHEDULE_MAX_SLEEP after
+that they must not be requested again, so the stand-in may see no more
+GETs for each of them than one run makes (retries and hedged twins
+included).
+"""
+
+import sys, os, signal, shutil, tempfile
+import argparse, logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import fc_update
+import bench_update
+
+FAILING = "/Tide/"
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+def run_daemon(workdir, seconds):
+    """ Run the daemon for the given seconds, returns {path: GETs} of the failing pages """
+    cwd = os.getcwd()
+
+    fc_update.DB_NAME = os.path.join(workdir, "db", "forecast.sqlite")
+    fc_update.RUN_LOCK_DIR = os.path.join(workdir, "locks")
+    sys.argv = [ "fc_update.py", "-D", "-n", "-s", os.path.join(workdir, "fc_update.sock"),
+                 "--trace-file", "", "--prom-file", "" ]
+    args = fc_update.parse_args()
+
+    os.chdir(workdir)
+
+    try:
+        with bench_update.StandInServer(0, 0) as server:
+            bench_update.redirect_upstreams(server)
+            bench_update.StandInHandler.failing = [ FAILING ]
+
+            signal.signal(signal.SIGALRM, interrupt)
+            signal.alarm(seconds)
+            fc_update.RefreshDaemon(args).run()
+    finally:
+        os.chdir(cwd)
+
+    return dict([ (path, count) for path, count in bench_update.StandInHandler.hits.items() if FAILING in path ])
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the daemon backs off from a failing upstream.")
+    parser.add_argument("-t", "--seconds", type=int, default=20,
+                        help="how long the daemon runs, must stay below SCHEDULE_MAX_SLEEP")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    workdir = tempfile.mkdtemp(prefix="fc_schedule.")
+
+    try:
+        hits = run_daemon(workdir, args.seconds)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # every attempt of a GET may get a hedged twin
+    limit = 2 * fc_update.RETRY_ATTEMPTS
+    failed = 0 if hits else 1
+
+    for path, count in sorted(hits.items()):
+        ok = count <= limit
+        failed += 0 if ok else 1
+
+        print("%-6s %-45s %d GETs in %d sec, at most %d expected" % ("ok" if ok else "FAILED", path, count,
+                                                                    args.seconds, limit))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Load test of the fc_update.py API server (-S).
+
+A scratch store is filled from the synthetic pages in fixtures/ through the
+stand-in server of bench_update.py, then fc_update.py -S is started on it,
+pinned to one CPU. Client processes, pinned to the other CPUs when there
+are any, replay a mix of manifest, fragment and forecast requests over
+keep-alive connections for a fixed time. A share of the requests revalidate
+with If-None-Match. The report (requests/s, latency p50/p95, status counts)
+is JSON.
+"""
+
+import sys, os, json, time, shutil, socket, tempfile, subprocess
+import argparse, logging, statistics, http.client, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import fc_update
+import bench_update
+
+SERVE_CODE = r'''
+import sys
+import fc_update
+fc_update.DB_NAME = sys.argv[1]
+sys.argv = [ "fc_update.py", "-S", sys.argv[2] ]
+fc_update.main()
+'''
+
+def seed_store(workdir):
+    """ Fill a store in workdir from the fixtures, returns its path """
+    db_file = os.path.join(workdir, "db", "forecast.sqlite")
+    store = fc_update.ForecastStore(db_file)
+    cwd = os.getcwd()
+
+    os.chdir(workdir)
+
+    try:
+        with bench_update.StandInServer(0, 0) as server:
+            bench_update.redirect_upstreams(server)
+            fc_update.update_html_files(fc_update.SITE_CATEG_ALL, sessions=fc_update.SessionPool(), store=store, force=True)
+    finally:
+        os.chdir(cwd)
+        store.close()
+
+    return db_file
+
+def get_paths():
+    paths = []
+
+    for categ, infos in fc_update.INFOS_MAP.items():
+        paths.append("/api/categs/%s" % (categ))
+
+        for info in infos:
+            paths.append("/api/sites/%s/forecast" % (info.name))
+            paths.extend([ "/api/sites/%s/%s" % (info.name, source) for source in fc_update.SOURCE_URL_FIELDS
+                           if getattr(info, fc_update.SOURCE_URL_FIELDS[source]) ])
+
+    return paths
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+
+    raise RuntimeError("API server did not start on port %d" % (port))
+
+def run_client(port, paths, seconds, revalidate, cpus, idx):
+    """ One keep-alive connection replaying paths, returns (latencies, status counts) """
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    etags = {}
+    latencies = []
+    status = {}
+    deadline = time.time() + seconds
+    count = idx
+
+    while time.time() < deadline:
+        path = paths[count % len(paths)]
+        headers = { "Accept-Encoding": "gzip" }
+
+        # spread the revalidating requests evenly over the run
+        if path in etags and int(count * revalidate) != int((count + 1) * revalidate):
+            headers["If-None-Match"] = etags[path]
+
+        start_tm = time.perf_counter()
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        latencies.append(time.perf_counter() - start_tm)
+
+        etags[path] = resp.getheader("ETag", "")
+        status[resp.status] = status.get(resp.status, 0) + 1
+        count += 1
+
+    conn.close()
+
+    return latencies, status
+
+def run_load(port, clients, seconds, revalidate, cpus):
+    paths = get_paths()
+
+    with multiprocessing.Pool(clients) as pool:
+        start_tm = time.perf_counter()
+        results = pool.starmap(run_client, [ (port, paths, seconds, revalidate, cpus, idx) for idx in range(clients) ])
+        elapsed = time.perf_counter() - start_tm
+
+    latencies = sorted([ latency for result in results for latency in result[0] ])
+    status = {}
+
+    for _, counts in results:
+        for code, count in counts.items():
+            status[str(code)] = status.get(str(code), 0) + count
+
+    return {
+        "clients": clients,
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": latencies[int(0.50 * (len(latencies) - 1))] * 1000,
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "status": status,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the fc_update.py API server against fixture data.")
+    parser.add_argument("-c", "--clients", type=int, default=4, help="client processes, one connection each")
+    parser.add_argument("-t", "--seconds", type=float, default=10, help="duration of the run")
+    parser.add_argument("-r", "--revalidate", type=float, default=0.5,
+                        help="share of requests sent with If-None-Match")
+    parser.add_argument("--server-cpu", type=int, default=0, help="CPU the server is pinned to")
+    parser.add_argument("-o", "--output", default="", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix="fc_load.")
+    port = get_free_port()
+    cpus = set(os.sched_getaffinity(0)) - { args.server_cpu }
+    server = None
+
+    try:
+        db_file = seed_store(workdir)
+        server = subprocess.Popen([ sys.executable, "-c", SERVE_CODE, db_file, "127.0.0.1:%d" % (port) ],
+                                  cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."),
+                                  stderr=subprocess.DEVNULL,
+                                  preexec_fn=lambda: os.sched_setaffinity(0, { args.server_cpu }))
+        wait_for_port(port)
+
+        report = run_load(port, args.clients, args.seconds, args.revalidate, cpus)
+        report["server_cpu"] = args.server_cpu
+        report["client_cpus"] = sorted(cpus) if cpus else "shared with the server"
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    txt = json.dumps(report, indent=1)
+
+    if args.output:
+        with open(args.output, "w") as fd:
+            fd.write(txt + "\n")
+    else:
+        print(txt)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,31 @@
 <?php
 
+define("SOCK_PATH", "/tmp/fc_update.sock");
+define("CGI_TIMEOUT", 30);
+
 $site_categ = $_GET['categ'];
-/* TODO: log file permission issue */
-$cmd = "python3 fc_update.py -c $site_categ >/tmp/fc_update.php.log 2>&1";
-$res = exec($cmd, $output, $ret);
+
+/* a shape check only, fc_update.py accepts nothing but the categories of spots.json */
+if (!preg_match('/^[A-Za-z0-9_-]{1,64}$/', $site_categ)) {
+	header('HTTP/1.1 400 Bad Request');
+	exit();
+}
+
+/* Ask the resident daemon (fc_update.py -D) first, it answers "ok ..." once the page is rebuilt */
+$sock = @stream_socket_client("unix://" . SOCK_PATH, $errno, $errstr, 1);
+
+if ($sock) {
+	stream_set_timeout($sock, CGI_TIMEOUT);
+	fwrite($sock, "refresh $site_categ\n");
+	$reply = fgets($sock);
+	fclose($sock);
+
+	$ret = ($reply !== false && strncmp($reply, "ok", 2) == 0) ? 0 : 1;
+} else {
+	/* TODO: log file permission issue */
+	$cmd = "python3 fc_update.py -c " . escapeshellarg($site_categ) . " >/tmp/fc_update.php.log 2>&1";
+	$res = exec($cmd, $output, $ret);
+}
 
 if ($ret == 0) {
 	echo "success";
@@ -13,4 +35,4 @@ if ($ret == 0) {
 
 exit();
 
-?>
\ No newline at end of file
+?>
@@ -1,119 +1,571 @@
 #!/usr/bin/env python3
 
 import logging
-import requests, bs4
 import threading
-import shelve
+import sqlite3
 import sys, os, shutil, datetime, traceback
 import argparse
-import io, time
-import collections
+import io, time, re, math, array, struct, random
+import collections, functools, contextlib
+import json, hashlib, html
+import urllib.parse
+import socket, socketserver, signal, fcntl
+import mmap, bisect
+import gzip
+
+# requests, bs4 and asyncio are imported where they are used, a render-only
+# run does not pay for the network stack
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # LOG_LEVEL = logging.DEBUG
 LOG_LEVEL = logging.INFO
 LOG_DATE_FMT = "%b %d %H:%M:%S"
-DB_NAME = "/tmp/fc_update/data.db"
+DB_NAME = "/tmp/fc_update/forecast.sqlite"
+DB_BUSY_TIMEOUT = 10
+ARCHIVE_DIRNAME = "archive" # next to the store
+ARCHIVE_COMPACT_AGE = 30*24*60*60 # older partitions keep one run per ARCHIVE_KEEP_EVERY
+ARCHIVE_KEEP_EVERY = 24*60*60
+ARCHIVE_RETENTION = 2*365*24*60*60
+CACHE_DIR = "/tmp/fc_update_cache"
+TRACE_FILE = "/tmp/fc_update_trace.json"
+PROM_FILE = "/tmp/fc_update.prom"
 JP_IMG_FILE = "cwm_ljp.gif"
 JP_IMG_URL = "http://www.imocwx.com/cwm/cwm_ljp.gif"
+JP_IMG_CACHE_TTL = 15*60
+JP_IMG_DIR = "charts" # published charts, content-hashed names, to be served with far-future expiry
+JP_IMG_MANIFEST = "index.json"
+JP_IMG_HISTORY = 8 # charts kept for the prev/next view, newest first
 CHUNK_SIZE = 100*1024
+POOL_SIZE = 16
+HTTP_TIMEOUT = (5, 20) # (connect, read) in seconds, an attempt never outlives its task's deadline
+RETRY_ATTEMPTS = 3 # per GET, on connection errors, timeouts, 429 and 5xx
+RETRY_BACKOFF = (0.5, 4) # (base, cap) seconds, the wait before attempt n is uniform in [0, min(cap, base*2^n)]
+RETRY_MIN_BUDGET = 1 # seconds an attempt needs left before its deadline to be worth sending
+HEDGE_MIN_SAMPLES = 20 # responses from a host before its p95 is trusted
+HEDGE_SAMPLES = 200 # latest response times kept per host
+PARSER_AUTO = "auto"
+PARSER_ALL = [ PARSER_AUTO, "lxml", "html.parser" ]
+ENGINE_ASYNCIO = "asyncio"
+ENGINE_THREAD = "thread"
+ENGINE_ALL = [ ENGINE_ASYNCIO, ENGINE_THREAD ]
+MAX_CONCURRENCY = 16
+HOST_CONCURRENCY = 4
+HOST_BUDGET = 200 # fetches per upstream host per run, the stalest fragments go first
+WORKERS = 1 # fetch processes, each one owns a share of the upstream hosts
+PARSE_WORKERS = 1 # parse processes fed by the fetch threads, 1 parses in the fetch threads
+MP_START_METHOD = "forkserver" # worker processes never fork the threaded parent
+PARSE_BACKLOG = 2 # bodies queued per parse process before the fetch threads wait
+TASK_DEADLINE = 20
+RUN_DEADLINE = 25 # must stay below CGI_TIMEOUT in js/main.js
+SOCK_PATH = "/tmp/fc_update.sock"
+CONTROL_TIMEOUT = 30
+RUN_LOCK_DIR = "/tmp/fc_update/locks"
+FRESH_WINDOW = 60 # seconds a finished update of a category satisfies new requests
+SCHEDULE_MAX_SLEEP = 5*60
+API_ADDR = "127.0.0.1:8765"
+API_CACHE_TTL = 5 # seconds a response built from the store is served from memory
+API_IDLE_TIMEOUT = 30 # seconds a keep-alive connection may sit idle
+API_GZIP_MIN_SIZE = 1024
 KEY_WG = "wg_data"
 KEY_TIDE = "tide_data"
 KEY_WEATHER = "weather_data"
+KEY_JP_IMG = "jp_img"
+SOURCE_ALL = [ KEY_WG, KEY_TIDE, KEY_WEATHER, KEY_JP_IMG ]
+SOURCE_URL_FIELDS = { KEY_WG: 'wg_url', KEY_TIDE: 'tide_url', KEY_WEATHER: 'weather_url' }
+# upstream publish cadence, a stored fragment younger than this is not refetched
+SOURCE_CADENCE = {
+    KEY_WG: 3*60*60,
+    KEY_WEATHER: 3*60*60,
+    KEY_TIDE: 24*60*60,
+    KEY_JP_IMG: 60*60,
+}
+# windguru forecast parameters kept as columns: wind speed, gusts and direction,
+# significant wave height, peak period and direction, temperature
+WG_COLUMNS = [ "WINDSPD", "GUST", "WINDDIR", "HTSGW", "PERPW", "DIRPW", "TMP" ]
 TIDE_DATA_DAYS = 4
+LOCAL_UTC_OFFSET = 8 # hours, Taiwan and Bali alike; tide tables are in local time
+SESSION_HOURS = (6, 18) # local daylight hours worth surfing
+MIN_SESSION_SCORE = 3.0 # out of 10
+BEST_SESSIONS = 10 # ranked sessions shown per category
+SESSIONS_FILE = "best_sessions.json"
+LAST_UPD_FILE = "last_upd.json" # rewritten every render, an unchanged page reads its update time from it
 MSW_SITE = "http://magicseaweed.com/"
 CWB_SITE = "http://www.cwb.gov.tw/"
 
-SITE_CATEG_TWN = "twn"
-SITE_CATEG_TWE = "twe"
-SITE_CATEG_TWW = "tww"
-SITE_CATEG_BALI = "bali"
-SITE_CATEG_TW = [ SITE_CATEG_TWN, SITE_CATEG_TWE, SITE_CATEG_TWW ]
-SITE_CATEG_ALL = [ SITE_CATEG_TWN, SITE_CATEG_TWE, SITE_CATEG_TWW, SITE_CATEG_BALI ]
+# spots and categories, see load_catalog()
+CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spots.json")
+REGION_TW = "tw" # categories of this region show the JP weather chart
+
+# orientation: the direction the beach faces, in degrees clockwise from north
+SiteInfo = collections.namedtuple('SiteInfo', ('name', 'wg_url', 'tide_url', 'weather_url', 'orientation'),
+                                  defaults=("", "", "", None))
+FetchTask = collections.namedtuple('FetchTask', ('name', 'url', 'func', 'args'))
+TaskResult = collections.namedtuple('TaskResult', ('name', 'url', 'ok', 'error', 'elapsed'))
+ArchiveChunk = collections.namedtuple('ArchiveChunk', ('partition', 'issued', 'valid', 'columns'))
+ApiResponse = collections.namedtuple('ApiResponse', ('content_hash', 'content_type', 'body', 'gzip_body', 'loaded_at'))
+StoreRow = collections.namedtuple('StoreRow', ('site', 'source', 'fetched_at', 'hash', 'payload'))
+PlanItem = collections.namedtuple('PlanItem', ('info', 'source')) # info is None for the JP chart
+
+def load_catalog(filepath):
+    """ ({categ: [SiteInfo]}, {region: [categ]}) in catalog order.
+
+    {"categories": [{"name": "twn", "region": "tw", "spots": [{"name": ..., "wg_url": ..., ...}]}]}
+    where a spot has the fields of SiteInfo.
+    """
+    with io.open(filepath, encoding='utf-8') as fd:
+        catalog = json.load(fd)
 
-SiteInfo = collections.namedtuple('SiteInfo', ('name', 'wg_url', 'tide_url', 'weather_url'))
+    infos_map = collections.OrderedDict()
+    region_map = collections.OrderedDict()
+
+    for categ in catalog['categories']:
+        infos_map[categ['name']] = [ SiteInfo(**spot) for spot in categ['spots'] ]
+        region_map.setdefault(categ.get('region', ''), []).append(categ['name'])
+
+    return infos_map, region_map
 
 # TW windguru: http://dracula0911.blogspot.tw/2013/11/blog-post.html
-INFOS_MAP = {
-    SITE_CATEG_TWN : [
-        SiteInfo("honeymoonbay",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=174669",
-                 tide_url = "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/000204.htm",
-                 weather_url = "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/1000204.htm"),
-        SiteInfo("suao",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=167601",
-                 tide_url = "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/000203.htm",
-                 weather_url = "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/1000203.htm"),
-        SiteInfo("zhongjiao",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=167612",
-                 tide_url = "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/500027.htm",
-                 weather_url = "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/6502700.htm")
-    ],
-    SITE_CATEG_TWE : [
-        SiteInfo("donghe",
-                 # wg_url = "http://old.windguru.cz/int/index.php?sc=473042",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=174509",
-                 tide_url = "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/001407.htm",
-                 weather_url = "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/1001407.htm"),
-        SiteInfo("yiwan",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=167746",
-                 tide_url = "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/001402.htm",
-                 weather_url = "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/1001402.htm"),
-        SiteInfo("fongbin",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=167744",
-                 tide_url = "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/001508.htm",
-                 weather_url = "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/1001508.htm"),
-        SiteInfo("papayastream",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=167745",
-                 tide_url = "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/001505.htm",
-                 weather_url = "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/1001505.htm")
-    ],
-    SITE_CATEG_TWW : [
-        SiteInfo("daan",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=179235",
-                 tide_url = "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/600011.htm",
-                 weather_url = "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/6601100.htm"),
-        SiteInfo("machang",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=360240",
-                 tide_url = "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/700033.htm",
-                 weather_url = "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/6703300.htm"),
-        SiteInfo("qijun",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=173865",
-                 tide_url = "http://www.cwb.gov.tw/V7/forecast/fishery/Tidal30days/401000.htm",
-                 weather_url = "http://www.cwb.gov.tw//V7/forecast/town368/3Hr/6403000.htm"),
-    ],
-    SITE_CATEG_BALI : [
-        SiteInfo("canggu",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=208484",
-                 tide_url = "http://magicseaweed.com/Canggu-Surf-Report/935/Tide/",
-                 weather_url = ""),
-        SiteInfo("sanur",
-                 wg_url = "http://old.windguru.cz/int/index.php?sc=208480",
-                 tide_url = "http://magicseaweed.com/Sanur-Surf-Report/1272/Tide/",
-                 weather_url = "")
-    ]
-}
+INFOS_MAP, REGION_MAP = load_catalog(CATALOG_FILE)
+SITE_CATEG_ALL = list(INFOS_MAP)
+SITE_CATEG_TW = REGION_MAP.get(REGION_TW, [])
 
 #################
 ##    Class    ##
 #################
 
+def get_class_pattern(cls):
+    """ Match one class in a multi-valued class attribute, SoupStrainer sees the raw value. """
+    return re.compile(r'(^|\s)%s(\s|$)' % (re.escape(cls)))
+
+@functools.lru_cache()
+def get_parser_backend(parser):
+    if parser != PARSER_AUTO:
+        return parser
+
+    try:
+        import lxml
+        return "lxml"
+    except ImportError:
+        return "html.parser"
+
+class RunMetrics(object):
+    """ Stage timings, byte counts and cache results of one update run. """
+
+    STAGE_CONNECT = "connect"   # request sent -> headers received (dns, connect, server time)
+    STAGE_DOWNLOAD = "download" # body transfer
+    STAGE_PARSE = "parse"
+    STAGE_PARSE_WAIT = "parse_wait" # body downloaded -> a parse process is free to take it
+    STAGE_DB_WRITE = "db_write"
+    STAGE_RENDER = "render"
+    STAGE_SCORE = "score"
+    STAGE_PUBLISH = "publish" # chart copies and transcoding
+
+    def __init__(self):
+        self.start_tm = time.time()
+        self.end_tm = 0
+        self.spans = []
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    def get_task(self, site, source):
+        return TaskMetrics(self, site, source)
+
+    def add_span(self, site, source, stage, seconds):
+        with self.lock:
+            self.spans.append({ 'site': site, 'source': source, 'stage': stage,
+                                'start': time.time() - seconds - self.start_tm, 'seconds': seconds })
+
+    def count(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def finish(self):
+        self.end_tm = time.time()
+
+    def merge(self, start_tm, spans, counters):
+        """ Add the spans and counters of a RunMetrics that started at start_tm,
+        in a worker process """
+        with self.lock:
+            self.spans.extend([ dict(span, start=span['start'] + start_tm - self.start_tm) for span in spans ])
+            self.counters.update(counters)
+
+    def write_trace(self, filepath):
+        trace = {
+            'start': self.start_tm,
+            'seconds': self.end_tm - self.start_tm,
+            'spans': self.spans,
+            'counters': [ dict(labels, name=name, value=value) for (name, labels), value in self.__get_counters() ],
+        }
+
+        write_file_atomic(filepath, json.dumps(trace, indent=1).encode('utf-8'))
+
+    def write_prometheus(self, filepath):
+        """ Text exposition format, for the node exporter textfile collector. """
+        lines = []
+        stage_seconds = collections.Counter()
+
+        for span in self.spans:
+            stage_seconds[(span['site'], span['source'], span['stage'])] += span['seconds']
+
+        lines.append("# HELP fc_update_stage_seconds Seconds spent per site, source and stage in the last run.")
+        lines.append("# TYPE fc_update_stage_seconds gauge")
+        for (site, source, stage), seconds in sorted(stage_seconds.items()):
+            lines.append('fc_update_stage_seconds{site="%s",source="%s",stage="%s"} %f' % (site, source, stage, seconds))
+
+        for name, help_txt in (("bytes", "Bytes downloaded per site and source in the last run."),
+                               ("cache", "Response cache results per site and source in the last run."),
+                               ("tasks", "Fetch tasks per result in the last run."),
+                               ("requests", "Retried and hedged requests per site and source in the last run."),
+                               ("pages", "Rendered pages per result in the last run.")):
+            lines.append("# HELP fc_update_%s %s" % (name, help_txt))
+            lines.append("# TYPE fc_update_%s gauge" % (name))
+
+            for (counter_name, labels), value in self.__get_counters():
+                if counter_name == name:
+                    label_txt = ",".join([ '%s="%s"' % (key, val) for key, val in labels ])
+                    lines.append('fc_update_%s{%s} %d' % (name, label_txt, value))
+
+        lines.append("# HELP fc_update_run_seconds Duration of the last run.")
+        lines.append("# TYPE fc_update_run_seconds gauge")
+        lines.append("fc_update_run_seconds %f" % (self.end_tm - self.start_tm))
+        lines.append("# HELP fc_update_last_run_timestamp_seconds End time of the last run.")
+        lines.append("# TYPE fc_update_last_run_timestamp_seconds gauge")
+        lines.append("fc_update_last_run_timestamp_seconds %d" % (self.end_tm))
+
+        write_file_atomic(filepath, ("\n".join(lines) + "\n").encode('utf-8'))
+
+    def __get_counters(self):
+        with self.lock:
+            return sorted(self.counters.items())
+
+class TaskMetrics(object):
+    """ RunMetrics bound to one (site, source). """
+
+    def __init__(self, run_metrics, site, source):
+        self.run_metrics = run_metrics
+        self.site = site
+        self.source = source
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start_tm = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(stage, time.perf_counter() - start_tm)
+
+    def add_span(self, stage, seconds):
+        self.run_metrics.add_span(self.site, self.source, stage, seconds)
+
+    def count(self, name, value=1, **labels):
+        labels = tuple(sorted(dict(labels, site=self.site, source=self.source).items()))
+        self.run_metrics.count(name, labels, value)
+
+class CacheEntry(object):
+    def __init__(self, url, etag='', last_modified='', fetched_at=0, body_hash='', data=None):
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+        self.body_hash = body_hash
+        self.data = data if data else {}
+
+    def is_fresh(self, ttl):
+        return time.time() < self.fetched_at + ttl
+
+    def get_validators(self):
+        headers = {}
+
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        return headers
+
+class ResponseCache(object):
+    """On-disk cache of upstream bodies, their validators and parsed data."""
+
+    def __init__(self, dirname=CACHE_DIR):
+        self.dirname = dirname
+
+    def load(self, url):
+        try:
+            with io.open(self.__get_path(url, ".json"), encoding='utf-8') as fd:
+                return CacheEntry(**json.load(fd))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def load_body(self, url):
+        try:
+            with open(self.__get_path(url, ".body"), "rb") as fd:
+                return fd.read()
+        except OSError:
+            return None
+
+    def get_body_path(self, url):
+        return self.__get_path(url, ".body")
+
+    def update(self, url, entry, resp):
+        """ Record a 200 response, parsed data is kept only if the body is unchanged. """
+        body = resp.content
+        body_hash = hashlib.sha1(body).hexdigest()
+        data = entry.data if entry and entry.body_hash == body_hash else {}
+
+        if not data:
+            write_file_atomic(self.get_body_path(url), body)
+
+        return CacheEntry(url,
+                          etag=resp.headers.get('ETag', ''),
+                          last_modified=resp.headers.get('Last-Modified', ''),
+                          fetched_at=time.time(),
+                          body_hash=body_hash,
+                          data=data)
+
+    def save(self, entry):
+        content = json.dumps(entry.__dict__, ensure_ascii=False)
+        write_file_atomic(self.__get_path(entry.url, ".json"), content.encode('utf-8'))
+
+    def __get_path(self, url, ext):
+        return os.path.join(self.dirname, hashlib.sha1(url.encode('utf-8')).hexdigest() + ext)
+
+class SessionPool(object):
+    """Keep-alive sessions shared by all fetchers, one connection pool per upstream host.
+
+    GETs are idempotent, so a failed or throttled one is retried after a
+    jittered backoff, and one still waiting past its host's p95 response
+    time gets a hedged twin; whichever answers first wins. No attempt, wait
+    or hedge runs past the deadline the caller passes in.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, timeout=HTTP_TIMEOUT):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.sessions = {}
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=HEDGE_SAMPLES))
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_session(self, url, cookies=None):
+        import requests
+        host = urllib.parse.urlsplit(url).netloc
+
+        with self.lock:
+            session = self.sessions.get(host)
+            if session:
+                return session
+
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+            if cookies:
+                session.cookies.update(cookies)
+
+            self.sessions[host] = session
+            logging.debug("New session for host [%s]" % (host))
+
+        return session
+
+    def get(self, url, cookies=None, metrics=None, deadline=None, **kwargs):
+        import requests
+
+        metrics = metrics if metrics else RunMetrics().get_task("", "")
+        deadline = deadline if deadline else time.time() + sum(self.timeout)
+
+        for attempt in range(RETRY_ATTEMPTS):
+            if attempt:
+                backoff = random.uniform(0, min(RETRY_BACKOFF[1], RETRY_BACKOFF[0] * 2**attempt))
+                if time.time() + backoff + RETRY_MIN_BUDGET > deadline:
+                    break
+
+                metrics.count("requests", result="retry")
+                time.sleep(backoff)
+
+            try:
+                resp = self.__get_hedged(url, cookies, metrics, deadline, kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                logging.warning("GET [%s] attempt %d failed: %s" % (url, attempt + 1, e))
+                error = e
+                continue
+
+            if resp.status_code != 429 and resp.status_code < 500:
+                return resp
+
+            logging.warning("GET [%s] attempt %d returned %d" % (url, attempt + 1, resp.status_code))
+            error = None
+
+        if error:
+            raise error
+
+        return resp
+
+    def get_p95(self, url):
+        """ 95th percentile response time of the url's host, None until there are enough samples """
+        with self.lock:
+            samples = sorted(self.latencies[urllib.parse.urlsplit(url).netloc])
+
+        return samples[int(0.95 * (len(samples) - 1))] if len(samples) >= HEDGE_MIN_SAMPLES else None
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+            if self.executor:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+    def __get_hedged(self, url, cookies, metrics, deadline, kwargs):
+        """ One attempt, with a second request sent if the first outlives the host's p95 """
+        import requests, concurrent.futures
+
+        p95 = self.get_p95(url)
+        if p95 is None or time.time() + p95 + RETRY_MIN_BUDGET > deadline:
+            return self.__do_get(url, cookies, metrics, deadline, kwargs)
+
+        executor = self.__get_executor()
+        futures = [ executor.submit(self.__do_get, url, cookies, metrics, deadline, kwargs) ]
+        done, _ = concurrent.futures.wait(futures, timeout=p95)
+
+        if not done:
+            logging.debug("Hedge GET [%s] after %.2f sec" % (url, p95))
+            metrics.count("requests", result="hedge")
+            futures.append(executor.submit(self.__do_get, url, cookies, metrics, deadline, kwargs))
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        # a failed request only counts if the other one failed too
+        winners = [ future for future in futures if future in done and not future.exception() ]
+        if not winners and len(done) < len(futures):
+            done, _ = concurrent.futures.wait(futures)
+            winners = [ future for future in futures if not future.exception() ]
+
+        if not winners:
+            raise futures[0].exception()
+
+        if winners[0] is not futures[0]:
+            metrics.count("requests", result="hedge_won")
+
+        return winners[0].result()
+
+    def __do_get(self, url, cookies, metrics, deadline, kwargs):
+        kwargs = dict(kwargs)
+        connect_timeout, read_timeout = kwargs.pop('timeout', self.timeout)
+        start_tm = time.time()
+        remaining = deadline - start_tm
+
+        if remaining < RETRY_MIN_BUDGET:
+            import requests
+            raise requests.Timeout("deadline reached before GET [%s]" % (url))
+
+        timeout = (min(connect_timeout, remaining), min(read_timeout, remaining))
+        resp = self.get_session(url, cookies).get(url, stream=True, timeout=timeout, **kwargs)
+        metrics.add_span(RunMetrics.STAGE_CONNECT, resp.elapsed.total_seconds())
+
+        with metrics.timed(RunMetrics.STAGE_DOWNLOAD):
+            metrics.count("bytes", len(resp.content))
+
+        with self.lock:
+            self.latencies[urllib.parse.urlsplit(url).netloc].append(time.time() - start_tm)
+
+        return resp
+
+    def __get_executor(self):
+        import concurrent.futures
+
+        with self.lock:
+            if not self.executor:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.pool_size, thread_name_prefix="hedge")
+
+            return self.executor
+
 class DataFetcher(object):
-    def __init__(self, url, cookie=''):
+    CACHE_TTL = 0
+    PARSE_ONLY = None # (name, attrs) of the only subtree _get_data looks at
+
+    def __init__(self, url, cookie='', cache=None, sessions=None, parser=PARSER_AUTO, metrics=None, parse_pool=None,
+                 deadline=None):
         self.url = url
         self.cookie = cookie
+        self.cache = cache
+        self.sessions = sessions if sessions else SessionPool()
+        self.parser = get_parser_backend(parser)
+        self.metrics = metrics if metrics else RunMetrics().get_task("", "")
+        self.parse_pool = parse_pool
+        self.deadline = deadline # time.time() the requests must be done by
 
     def fetch(self):
         if not self.url:
             return ""
 
-        resp = requests.get(self.url, cookies=self.cookie)
-        resp.raise_for_status()
-        resp.encoding = 'utf-8'
+        import requests
+
+        if not self.cache:
+            resp = self.sessions.get(self.url, cookies=self.cookie, metrics=self.metrics, deadline=self.deadline)
+            resp.raise_for_status()
+            return self.parse(resp.content)
+
+        name = self.__class__.__name__
+        entry = self.cache.load(self.url)
+
+        if entry and name in entry.data and not self._is_usable(entry.data[name]):
+            del entry.data[name]
+
+        if entry and name in entry.data and entry.is_fresh(self.CACHE_TTL):
+            logging.debug("Cache hit [%s]" % (self.url))
+            self.metrics.count("cache", result="hit")
+            return entry.data[name]
+
+        headers = entry.get_validators() if entry else {}
+        body = None
+        resp = self.sessions.get(self.url, cookies=self.cookie, metrics=self.metrics, deadline=self.deadline,
+                                 headers=headers)
+
+        if resp.status_code == requests.codes.not_modified and entry:
+            logging.debug("Not modified [%s]" % (self.url))
+            self.metrics.count("cache", result="not_modified")
+            entry.fetched_at = time.time()
+
+            if not name in entry.data:
+                body = self.cache.load_body(self.url)
+                if body is None:
+                    # validators survived but the body did not, refetch it unconditionally
+                    resp = self.sessions.get(self.url, cookies=self.cookie, metrics=self.metrics, deadline=self.deadline)
+
+        if resp.status_code != requests.codes.not_modified:
+            resp.raise_for_status()
+            self.metrics.count("cache", result="miss")
+            entry = self.cache.update(self.url, entry, resp)
+            body = resp.content
+
+        if not name in entry.data:
+            entry.data[name] = self.parse(body)
+
+        self.cache.save(entry)
 
-        data = []
-        soup = bs4.BeautifulSoup(resp.text, "html.parser")
+        return entry.data[name]
 
-        return self._get_data(soup)
+    def parse(self, body):
+        if self.parse_pool:
+            return self.parse_pool.parse(self, body)
+
+        import bs4
+
+        with self.metrics.timed(RunMetrics.STAGE_PARSE):
+            text = body.decode('utf-8', errors='replace')
+            parse_only = bs4.SoupStrainer(*self.PARSE_ONLY) if self.PARSE_ONLY else None
+            soup = bs4.BeautifulSoup(text, self.parser, parse_only=parse_only)
+
+            return self._get_data(soup)
+
+    def _is_usable(self, data):
+        return True
 
     def _get_data(self, soup):
         return ""
@@ -130,9 +582,11 @@ class WindGuruDataFetcher(DataFetcher):
         'nuid': 'c9e64acd664975d4ec262168f72044a7',
         'wg_cookie': '1|||||||||174509_174669||||0|_	'
     }
+    CACHE_TTL = 60*60
+    PARSE_ONLY = ('div', { 'id': 'div_wgfcst1' })
 
-    def __init__(self, url):
-        super(WindGuruDataFetcher, self).__init__(url, self.COOKIE)
+    def __init__(self, url, cache=None, sessions=None, parser=PARSER_AUTO, metrics=None, parse_pool=None, deadline=None):
+        super(WindGuruDataFetcher, self).__init__(url, self.COOKIE, cache, sessions, parser, metrics, parse_pool, deadline)
 
     def _get_data(self, soup):
         tag = soup.select_one('div#div_wgfcst1')
@@ -141,9 +595,31 @@ class WindGuruDataFetcher(DataFetcher):
         script = tag.select_one('script')
         del script['language']
 
-        return str(tag)
+        return { 'html': str(tag), 'fcst': self.__get_fcst(script.string or "") }
+
+    def _is_usable(self, data):
+        return isinstance(data, dict)
+
+    def __get_fcst(self, script):
+        """ WG_COLUMNS of the wg_fcst_tab_data_1 object the page script renders from """
+        match = re.search(r'wg_fcst_tab_data_1\s*=\s*', script)
+        if not match:
+            logging.warning("No forecast data in [%s]" % (self.url))
+            return None
+
+        try:
+            data, _ = json.JSONDecoder().raw_decode(script, match.end())
+            fcst = data['fcst'].get(str(data.get('id_model'))) or list(data['fcst'].values())[0]
+
+            return { 'model': data.get('model', ''), 'init_tm': fcst['initstamp'], 'hours': fcst['hours'],
+                     'columns': dict([ (name, fcst[name]) for name in WG_COLUMNS if name in fcst ]) }
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            logging.warning("Bad forecast data in [%s]: %s" % (self.url, e))
+            return None
 
 class WeatherDataFetcher(DataFetcher):
+    CACHE_TTL = 30*60
+    PARSE_ONLY = (None, { 'class': get_class_pattern('Forecast-box') })
     REMOVE_TR_IDX_7DAY = [ 5, 6, 7, 8, 9 ]
     REMOVE_TR_IDX_3HR = [ 4, 5, 6, 7, 9 ]
 
@@ -192,12 +668,18 @@ class WeatherDataFetcher(DataFetcher):
             return self.REMOVE_TR_IDX_3HR
 
 class MswTideDataFetcher(DataFetcher):
+    CACHE_TTL = 12*60*60
+    PARSE_ONLY = ('div', { 'class': get_class_pattern('msw-tide-tables') })
+
     def _get_data(self, soup):
         html = ""
+        tides = []
         day = 0
+        today = datetime.date.today()
 
         for div in soup.select('div.msw-tide-tables'):
             tag = div.select_one('table')
+            date = (today + datetime.timedelta(days=day)).isoformat()
 
             for tr in tag.select('tr'):
                 td = tr.select_one('td')
@@ -209,6 +691,12 @@ class MswTideDataFetcher(DataFetcher):
                     cls = ""
                 tr['class'] = cls
 
+                # td: High, 07:00am, 0.70m
+                cell = td.find_next_sibling('td')
+                tide = get_tide(date, cell.get_text() if cell else "", "%I:%M%p", cls == 'high-tide') if cls else None
+                if tide:
+                    tides.append(tide)
+
             del tag['class']
             html += str(tag)
 
@@ -216,34 +704,50 @@ class MswTideDataFetcher(DataFetcher):
             if day == TIDE_DATA_DAYS:
                 break
 
-        return '\n<div class="tide-tbls tide-msw">%s</div>\n' % (html)
+        return { 'html': '\n<div class="tide-tbls tide-msw">%s</div>\n' % (html), 'tides': tides }
+
+    def _is_usable(self, data):
+        return isinstance(data, dict)
 
 class CwbTideDataFetcher(DataFetcher):
+    """ Tidal30days pages hold a month of tides, so the parsed table is cached
+    as structured rows and each run only picks the current window from it. """
+    CACHE_TTL = 24*60*60
+    PARSE_ONLY = ('table', {})
+
+    def fetch(self):
+        days = super(CwbTideDataFetcher, self).fetch()
+        if not days:
+            return { 'html': "", 'tides': [] }
+
+        # the whole month of tides is kept for scoring, the page only shows the window
+        return { 'html': self.render(self.__get_window(days)), 'tides': self.get_tides(days) }
+
+    def _is_usable(self, days):
+        # rows cached before the raw cells were kept are parsed again
+        return len(self.__get_upcoming(days)) == TIDE_DATA_DAYS and \
+            all([ 'cells' in row for day in days for row in day['rows'] ])
+
     def _get_data(self, soup):
-        html = final_html =""
-        data1 = []
-        data2 = []
-        total_rows = 0
-        total_days = TIDE_DATA_DAYS
-        day = 0
-        row = 0
+        days = []
+        rows = []
+        today = datetime.date.today()
 
-        # td: 星期二, 大潮
+        # td: 09/20(星期三)農曆 08/01, 大潮
         for tag in soup.select('td[rowspan]'):
             if -1 == tag.get_text().find("星期"):
                 continue
 
-            del tag['style']
             text = tag.get_text()
             idx = text.find('農曆')
-            rowspan = int(tag['rowspan'])
-            total_rows += rowspan
-            html = '<td rowspan="%d">%s<br/>%s<br/>%s</td>' %(rowspan, text[0:idx], text[idx:], tag.next_sibling.get_text())
-            data1.append((html, rowspan))
-
-            day += 1
-            if day == total_days:
-                break
+            days.append({
+                'date': get_nearest_date(text[0:idx], today).isoformat(),
+                'label': text[0:idx],
+                'lunar': text[idx:],
+                'tide_range': tag.next_sibling.get_text(),
+                'rowspan': int(tag['rowspan']),
+                'rows': []
+            })
 
         # td: 乾潮, 10:51, 12cm
         for tag in soup.select('td'):
@@ -254,93 +758,1129 @@ class CwbTideDataFetcher(DataFetcher):
             else:
                 continue
 
-            html = '<td>%s</td>' % (tag.get_text().strip())
-            html += str(tag.next_sibling) + str(tag.next_sibling.next_sibling.next_sibling)
-            data2.append((cls, html))
+            rows.append({
+                'cls': cls,
+                'tide': tag.get_text().strip(),
+                'time': tag.next_sibling.get_text(),
+                'height': tag.next_sibling.next_sibling.next_sibling.get_text(),
+                # time and height cells as published, attributes and entities included
+                'cells': str(tag.next_sibling) + str(tag.next_sibling.next_sibling.next_sibling)
+            })
 
-            row += 1
-            if row == total_rows:
-                break
+        for day in days:
+            day['rows'] = rows[0:day['rowspan']]
+            rows = rows[day['rowspan']:]
+
+        return days
+
+    @staticmethod
+    def get_tides(days):
+        """ [timestamp, is_high] of every row whose time parses """
+        tides = [ get_tide(day['date'], row['time'], "%H:%M", row['cls'] == 'high-tide')
+                  for day in days for row in day['rows'] ]
 
-        # compose final_html
-        for html1, rowspan in data1:
+        return [ tide for tide in tides if tide ]
+
+    def __get_window(self, days):
+        """ The days from today on, the first days if the table has run past today """
+        return self.__get_upcoming(days) or days[0:TIDE_DATA_DAYS]
+
+    @staticmethod
+    def __get_upcoming(days):
+        today = datetime.date.today().isoformat()
+        return [ day for day in days if day['date'] >= today ][0:TIDE_DATA_DAYS]
+
+    def render(self, days):
+        """ Tide tables of the given days as shown on the page """
+        final_html = ""
+
+        for day in days:
             final_html += "<table><tbody>"
+            html1 = '<td rowspan="%d">%s<br/>%s<br/>%s</td>' % (day['rowspan'], day['label'], day['lunar'], day['tide_range'])
 
-            for cls, html2 in data2[0:rowspan]:
-                final_html += '<tr class="%s">%s</tr>' % (cls, html1 + html2)
+            for row in day['rows']:
+                html2 = '<td>%s</td>%s' % (row['tide'], row['cells'])
+                final_html += '<tr class="%s">%s</tr>' % (row['cls'], html1 + html2)
                 html1 = '' # clear content
 
             final_html += "</tbody></table>"
-            data2 = data2[rowspan:]
 
         final_html = '\n<div class="tide-tbls tide-cwb">%s</div>\n' % (final_html)
 
         return final_html
 
-class DatabaseUpdater(object):
-    def __init__(self, categs):
-        self.tgt_categs = categs
-        self.lock = threading.Lock()
-        self.threads = []
+class ForecastColumns(object):
+    """ Forecast of one spot as typed arrays: the forecast hours after
+    init_tm, and one float32 column per parameter with NaN for missing values.
+
+    to_bytes() is a little-endian blob: a length-prefixed JSON header, the
+    hours as uint16 and then every column in header order.
+    """
+
+    def __init__(self, model, init_tm, hours, columns):
+        self.model = model
+        self.init_tm = init_tm
+        self.hours = array.array('H', hours)
+        self.columns = {}
+
+        for name, values in columns.items():
+            values = [ math.nan if value is None else value for value in values[:len(self.hours)] ]
+            self.columns[name] = array.array('f', values + [ math.nan ] * (len(self.hours) - len(values)))
+
+    def __len__(self):
+        return len(self.hours)
+
+    def get(self, name):
+        return self.columns.get(name, array.array('f', [ math.nan ] * len(self.hours)))
+
+    def get_times(self):
+        """ UTC timestamp of every step """
+        return [ self.init_tm + hour*60*60 for hour in self.hours ]
+
+    def to_bytes(self):
+        names = sorted(self.columns)
+        header = json.dumps({ 'model': self.model, 'init_tm': self.init_tm, 'steps': len(self.hours),
+                              'names': names }).encode('utf-8')
+        chunks = [ struct.pack("<I", len(header)), header ]
+
+        for values in [ self.hours ] + [ self.columns[name] for name in names ]:
+            if sys.byteorder != "little":
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            chunks.append(values.tobytes())
+
+        return b"".join(chunks)
+
+    @classmethod
+    def from_bytes(cls, data):
+        header_len, = struct.unpack_from("<I", data)
+        header = json.loads(data[4:4 + header_len].decode('utf-8'))
+        offset = 4 + header_len
+        arrays = []
+
+        for typecode in [ 'H' ] + [ 'f' ] * len(header['names']):
+            values = array.array(typecode)
+            values.frombytes(data[offset:offset + header['steps'] * values.itemsize])
+            if sys.byteorder != "little":
+                values.byteswap()
+            offset += header['steps'] * values.itemsize
+            arrays.append(values)
+
+        columns = cls(header['model'], header['init_tm'], [], {})
+        columns.hours = arrays[0]
+        columns.columns = dict(zip(header['names'], arrays[1:]))
+
+        return columns
+
+class ForecastStore(object):
+    """ One row per (site, source) in an SQLite database in WAL mode.
+
+    Each thread gets its own connection, so fetchers write without a global
+    lock, and readers in other processes see the last committed rows while a
+    refresh is in progress. A shared store has one connection for all
+    threads instead, for servers starting a thread per client; its callers
+    serialize their calls. The file persists between runs.
+    """
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS fragments (
+            site TEXT NOT NULL,
+            source TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            hash TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (site, source))''',
+        '''CREATE TABLE IF NOT EXISTS pages (
+            categ TEXT PRIMARY KEY,
+            updated_at REAL NOT NULL,
+            failed INTEGER NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS rendered (
+            categ TEXT PRIMARY KEY,
+            hash TEXT NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS columns (
+            site TEXT PRIMARY KEY,
+            init_tm INTEGER NOT NULL,
+            data BLOB NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS tides (
+            site TEXT PRIMARY KEY,
+            data TEXT NOT NULL)''',
+    ]
+
+    def __init__(self, filepath=None, timeout=DB_BUSY_TIMEOUT, shared=False):
+        self.filepath = filepath if filepath else DB_NAME
+        self.timeout = timeout
+        self.local = threading.local()
+        self.shared = shared
+        self.conn = None # of a shared store
+
+    def put(self, site, source, payload):
+        """ Returns True if the payload differs from the stored one. """
+        payload_hash = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+        conn = self.get_conn()
+
+        with conn:
+            row = conn.execute("SELECT hash FROM fragments WHERE site=? AND source=?", (site, source)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?, ?)",
+                         (site, source, time.time(), payload_hash, payload))
+
+        return row is None or row[0] != payload_hash
+
+    def get(self, site, source):
+        row = self.get_conn().execute("SELECT * FROM fragments WHERE site=? AND source=?", (site, source)).fetchone()
+        return StoreRow(*row) if row else None
+
+    def get_site(self, site):
+        rows = self.get_conn().execute("SELECT source, payload FROM fragments WHERE site=?", (site,))
+        return dict(rows.fetchall())
+
+    def get_hashes(self, site):
+        """ {source: payload hash} of the fragments of site """
+        rows = self.get_conn().execute("SELECT source, hash FROM fragments WHERE site=?", (site,))
+        return dict(rows.fetchall())
+
+    def get_all_hashes(self):
+        """ {site: {source: payload hash}} of every stored fragment """
+        hashes = collections.defaultdict(dict)
+
+        for site, source, payload_hash in self.get_conn().execute("SELECT site, source, hash FROM fragments"):
+            hashes[site][source] = payload_hash
+
+        return hashes
+
+    def get_fetched_at(self):
+        """ {(site, source): fetched_at} of every stored fragment """
+        rows = self.get_conn().execute("SELECT site, source, fetched_at FROM fragments")
+        return dict([ ((site, source), fetched_at) for site, source, fetched_at in rows.fetchall() ])
+
+    def put_columns(self, site, columns):
+        with self.get_conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO columns VALUES (?, ?, ?)", (site, columns.init_tm, columns.to_bytes()))
+
+    def get_columns(self, site):
+        """ ForecastColumns of site, None if the spot has none stored """
+        row = self.get_conn().execute("SELECT data FROM columns WHERE site=?", (site,)).fetchone()
+        return ForecastColumns.from_bytes(row[0]) if row else None
+
+    def put_tides(self, site, tides):
+        with self.get_conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO tides VALUES (?, ?)", (site, json.dumps(tides)))
+
+    def get_tides(self, site):
+        """ [[timestamp, is_high], ...] of the tide extremes of site """
+        row = self.get_conn().execute("SELECT data FROM tides WHERE site=?", (site,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def set_page_updated(self, categ, failed):
+        with self.get_conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", (categ, time.time(), failed))
+
+    def get_page_updated(self, categ):
+        """ (updated_at, failed tasks) of the last coalesced update of categ """
+        row = self.get_conn().execute("SELECT updated_at, failed FROM pages WHERE categ=?", (categ,)).fetchone()
+        return row if row else (0, 0)
+
+    def set_page_hash(self, categ, page_hash):
+        with self.get_conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO rendered VALUES (?, ?)", (categ, page_hash))
+
+    def get_page_hash(self, categ):
+        """ Content hash of the page last rendered for categ """
+        row = self.get_conn().execute("SELECT hash FROM rendered WHERE categ=?", (categ,)).fetchone()
+        return row[0] if row else ''
+
+    def get_conn(self):
+        holder = self if self.shared else self.local
+        conn = getattr(holder, 'conn', None)
+        if conn:
+            return conn
+
+        check_to_create_parent_dir(self.filepath)
+        conn = sqlite3.connect(self.filepath, timeout=self.timeout, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        holder.conn = conn
+
+        return conn
+
+    def close(self):
+        holder = self if self.shared else self.local
+        conn = getattr(holder, 'conn', None)
+        if conn:
+            conn.close()
+            holder.conn = None
+
+class ForecastArchive(object):
+    """ Append-only history of the forecasts and tides of every run.
+
+    Rows are (issued, valid, values...) and a run appends one row per step.
+    They are partitioned by the month of the issue time:
+    <dirname>/<YYYY-MM>/<site>/<source>/ holds one file per column, i.e.
+    issued.i64, valid.i64 and <name>.f32. Every file is an array in native
+    byte order, sorted by issue time. Queries map the files read-only and
+    return memoryviews on them, so a range scan copies nothing and only
+    touches the months it covers.
+
+    A run is only appended when it is newer than the last one and differs
+    from it. An interrupted append leaves columns of different lengths; the
+    shortest length wins and the next append truncates the rest.
+    """
+
+    ISSUED = "issued.i64"
+    VALID = "valid.i64"
+    COLUMN_EXT = ".f32"
+
+    def __init__(self, dirname=None):
+        self.dirname = dirname if dirname else os.path.join(os.path.dirname(DB_NAME), ARCHIVE_DIRNAME)
+
+    def append(self, site, source, issued_tm, valid_times, columns):
+        """ Returns the number of rows appended """
+        path = self.__get_series_path(self.get_partition(issued_tm), site, source)
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, ".lock"), "a") as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+
+            chunk = self.__load(path)
+            rows = len(chunk.issued)
+            valid = array.array('q', valid_times)
+            values = dict([ (name, array.array('f', [ math.nan ] * len(valid))) for name in chunk.columns ])
+            values.update([ (name, array.array('f', column)) for name, column in columns.items() ])
+
+            if rows and (issued_tm <= chunk.issued[-1] or self.__is_last_run(chunk, valid, values)):
+                return 0
+
+            files = [ (self.ISSUED, array.array('q', [ issued_tm ] * len(valid))), (self.VALID, valid) ]
+            files += [ (name + self.COLUMN_EXT, column) for name, column in values.items() ]
+
+            for filename, column in files:
+                with open(os.path.join(path, filename), "ab") as fd:
+                    size = os.fstat(fd.fileno()).st_size // column.itemsize
+
+                    # drop a torn tail, pad a column added since the first run
+                    if size > rows:
+                        fd.truncate(rows * column.itemsize)
+                    elif size < rows:
+                        fd.write(array.array(column.typecode, [ math.nan ] * (rows - size)).tobytes())
+
+                    fd.write(column.tobytes())
+
+        return len(valid)
+
+    def query(self, site, source, start_tm, end_tm, names=None):
+        """ [ArchiveChunk] of the runs issued in [start_tm, end_tm), one per month.
+        names limits the columns returned, all of them by default. """
+        chunks = []
+
+        for partition in self.get_partitions(start_tm, end_tm):
+            path = self.__get_series_path(partition, site, source)
+            if not os.path.isdir(path):
+                continue
+
+            chunk = self.__load(path)
+            low = bisect.bisect_left(chunk.issued, start_tm)
+            high = bisect.bisect_left(chunk.issued, end_tm)
+
+            if low < high:
+                chunks.append(ArchiveChunk(partition, chunk.issued[low:high], chunk.valid[low:high],
+                                           dict([ (name, column[low:high]) for name, column in chunk.columns.items()
+                                                  if names is None or name in names ])))
+
+        return chunks
+
+    def maintain(self, now=None):
+        """ Compact the partitions older than ARCHIVE_COMPACT_AGE, delete the ones
+        older than ARCHIVE_RETENTION. Returns (series compacted, partitions deleted). """
+        now = now if now else time.time()
+        compacted = 0
+        deleted = 0
+
+        for partition in self.get_partitions():
+            end_tm = self.get_partition_end(partition)
+
+            if end_tm < now - ARCHIVE_RETENTION:
+                shutil.rmtree(os.path.join(self.dirname, partition), ignore_errors=True)
+                deleted += 1
+            elif end_tm < now - ARCHIVE_COMPACT_AGE:
+                for site in os.listdir(os.path.join(self.dirname, partition)):
+                    for source in os.listdir(os.path.join(self.dirname, partition, site)):
+                        compacted += self.__compact(self.__get_series_path(partition, site, source))
+
+        logging.info("Archive: %d series compacted, %d partitions deleted" % (compacted, deleted))
+
+        return compacted, deleted
+
+    def get_partitions(self, start_tm=None, end_tm=None):
+        """ Existing partitions overlapping [start_tm, end_tm), oldest first """
+        try:
+            partitions = sorted([ name for name in os.listdir(self.dirname) if re.match(r'^\d{4}-\d{2}$', name) ])
+        except OSError:
+            return []
+
+        return [ partition for partition in partitions
+                 if (start_tm is None or self.get_partition_end(partition) > start_tm) and
+                    (end_tm is None or self.get_partition_start(partition) < end_tm) ]
+
+    @staticmethod
+    def get_partition(tm):
+        return datetime.datetime.utcfromtimestamp(tm).strftime("%Y-%m")
+
+    @staticmethod
+    def get_partition_start(partition):
+        return datetime.datetime.strptime(partition, "%Y-%m").replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    @classmethod
+    def get_partition_end(cls, partition):
+        start = datetime.datetime.strptime(partition, "%Y-%m")
+        end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+        return end.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    def __compact(self, path):
+        """ Keep the first run of every ARCHIVE_KEEP_EVERY, returns 1 if the series was rewritten """
+        with open(os.path.join(path, ".lock"), "a") as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+
+            chunk = self.__load(path)
+            keep = []
+            bucket = None
+
+            for idx, issued_tm in enumerate(chunk.issued):
+                if idx == 0 or issued_tm != chunk.issued[idx - 1]:
+                    keep_run = bucket != issued_tm // ARCHIVE_KEEP_EVERY
+                    bucket = issued_tm // ARCHIVE_KEEP_EVERY
+                if keep_run:
+                    keep.append(idx)
+
+            if len(keep) == len(chunk.issued):
+                return 0
+
+            files = [ (self.ISSUED, chunk.issued), (self.VALID, chunk.valid) ]
+            files += [ (name + self.COLUMN_EXT, column) for name, column in chunk.columns.items() ]
+
+            for filename, column in files:
+                kept = array.array(column.format, [ column[idx] for idx in keep ])
+                write_file_atomic(os.path.join(path, filename), kept.tobytes())
+
+        return 1
+
+    def __load(self, path):
+        """ ArchiveChunk of a whole series, cut to the shortest column """
+        columns = dict([ (filename[:-len(self.COLUMN_EXT)], self.__map(os.path.join(path, filename), 'f'))
+                         for filename in os.listdir(path) if filename.endswith(self.COLUMN_EXT) ])
+        issued = self.__map(os.path.join(path, self.ISSUED), 'q')
+        valid = self.__map(os.path.join(path, self.VALID), 'q')
+        rows = min([ len(issued), len(valid) ] + [ len(column) for column in columns.values() ])
+
+        return ArchiveChunk(os.path.basename(os.path.dirname(os.path.dirname(path))), issued[:rows], valid[:rows],
+                            dict([ (name, column[:rows]) for name, column in columns.items() ]))
+
+    @staticmethod
+    def __map(filepath, typecode):
+        """ Read-only memoryview of a column file, empty if it does not exist """
+        try:
+            with open(filepath, "rb") as fd:
+                size = os.fstat(fd.fileno()).st_size
+                itemsize = array.array(typecode).itemsize
+
+                if size < itemsize:
+                    return memoryview(b"").cast(typecode)
+
+                view = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+                return view[:size - size % itemsize].cast(typecode)
+        except FileNotFoundError:
+            return memoryview(b"").cast(typecode)
+
+    @staticmethod
+    def __is_last_run(chunk, valid, values):
+        start = bisect.bisect_left(chunk.issued, chunk.issued[-1])
+
+        return chunk.valid[start:].tobytes() == valid.tobytes() and \
+            all([ chunk.columns[name][start:].tobytes() == column.tobytes() for name, column in values.items()
+                  if name in chunk.columns ]) and set(values) == set(chunk.columns)
+
+    def __get_series_path(self, partition, site, source):
+        return os.path.join(self.dirname, partition, site, source)
+
+class RefreshPlanner(object):
+    """ Decide which (site, source) fragments of the requested categories need
+    fetching: the ones never fetched or older than their upstream cadence.
+    Fragments that fail to refetch stay stale in the plan and keep being
+    served from the store meanwhile. A planner that outlives one run also
+    remembers when it planned each fragment, and does not plan it again
+    within retry_interval, so a failing upstream is retried at that pace. """
+
+    def __init__(self, store, cadence=SOURCE_CADENCE, retry_interval=0):
+        self.store = store
+        self.cadence = cadence
+        self.retry_interval = retry_interval
+        self.attempted_at = {}
+
+    def plan(self, categs, sources=SOURCE_ALL, force=False, host_budget=HOST_BUDGET):
+        fetched_at = self.store.get_fetched_at()
+        now = time.time()
+        due = [ item for item in self.get_items(categs, sources)
+                if force or self.__get_due_tm(item, fetched_at) <= now ]
+
+        # stalest first, the ones over a host budget stay due for the next run
+        due.sort(key=lambda item: fetched_at.get(self.get_key(item), 0))
+        host_counts = collections.Counter()
+        plan = []
+
+        for item in due:
+            host_counts[self.get_host(item)] += 1
+            if host_counts[self.get_host(item)] <= host_budget:
+                plan.append(item)
+
+        if len(plan) < len(due):
+            logging.info("%d fragments deferred by host budgets" % (len(due) - len(plan)))
+
+        for item in plan:
+            self.attempted_at[self.get_key(item)] = now
+
+        return plan
+
+    def get_next_due(self, categs, sources=SOURCE_ALL):
+        fetched_at = self.store.get_fetched_at()
+
+        return min([ self.__get_due_tm(item, fetched_at) for item in self.get_items(categs, sources) ])
+
+    def __get_due_tm(self, item, fetched_at):
+        key = self.get_key(item)
+
+        return max(fetched_at.get(key, 0) + self.cadence[item.source],
+                   self.attempted_at.get(key, 0) + self.retry_interval)
+
+    def get_items(self, categs, sources=SOURCE_ALL):
+        items = []
+
+        if KEY_JP_IMG in sources and [ categ for categ in categs if categ in SITE_CATEG_TW ]:
+            items.append(PlanItem(None, KEY_JP_IMG))
+
+        for categ in categs:
+            for info in INFOS_MAP.get(categ, []):
+                items.extend([ PlanItem(info, source) for source in SOURCE_URL_FIELDS
+                               if source in sources and getattr(info, SOURCE_URL_FIELDS[source]) ])
+
+        return items
+
+    @staticmethod
+    def get_key(item):
+        return (item.info.name, item.source) if item.info else (KEY_JP_IMG, KEY_JP_IMG)
+
+    @staticmethod
+    def get_host(item):
+        url = getattr(item.info, SOURCE_URL_FIELDS[item.source]) if item.info else JP_IMG_URL
+        return urllib.parse.urlsplit(url).netloc
+
+    @classmethod
+    def index_by_host(cls, items):
+        """ {upstream host: [PlanItem]} """
+        index = collections.OrderedDict()
+
+        for item in items:
+            index.setdefault(cls.get_host(item), []).append(item)
+
+        return index
+
+    @classmethod
+    def shard(cls, plan, shards):
+        """ Split plan in at most shards parts, each upstream host in exactly one
+        of them so per-host limits hold across worker processes. Biggest hosts are
+        placed first, each on the part with the fewest items. """
+        parts = [ [] for _ in range(shards) ]
+
+        for items in sorted(cls.index_by_host(plan).values(), key=len, reverse=True):
+            min(parts, key=len).extend(items)
+
+        return [ part for part in parts if part ]
+
+class RunCoalescer(object):
+    """ Single-flight for update runs, across threads and processes.
+
+    A run holds an flock on the lock file of each of its categories while it
+    runs. A run arriving while every category it asks for is held waits for
+    the runs in flight and takes their result instead of fetching again. One
+    that overlaps only partly waits for the overlapping categories, then runs
+    unless its categories were all updated less than fresh_window seconds ago.
+    Locks are always waited for in sorted order, so overlapping runs cannot
+    deadlock.
+    """
+
+    RUN = "run"
+    JOINED = "joined"
+    FRESH = "fresh"
+
+    def __init__(self, categs, store, fresh_window=FRESH_WINDOW):
+        self.categs = sorted(set(categs))
+        self.store = store
+        self.fresh_window = fresh_window
+        self.lock_paths = [ os.path.join(RUN_LOCK_DIR, categ + ".lock") for categ in self.categs ]
+
+    def run(self, func):
+        """ Returns (how, failed tasks), func returns the task results of a run. """
+        check_to_create_parent_dir(self.lock_paths[0])
+
+        with contextlib.ExitStack() as stack:
+            fds = [ stack.enter_context(open(lock_path, "a")) for lock_path in self.lock_paths ]
+            busy = [ fd for fd in fds if not self.__try_lock(fd) ]
+
+            if busy:
+                # whatever was taken is given back so every fd is waited for in order
+                for fd in fds:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+                logging.info("Update of [%s] in flight, waiting for it" %
+                             (", ".join([ categ for categ, fd in zip(self.categs, fds) if fd in busy ])))
+
+                for fd in fds:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+
+                if len(busy) == len(fds):
+                    return (self.JOINED, self.__get_failed())
+
+            if self.__is_fresh():
+                logging.info("[%s] updated within %d sec, skipped" % (", ".join(self.categs), self.fresh_window))
+                return (self.FRESH, self.__get_failed())
+
+            results = func()
+            failed = len([ result for result in results if not result.ok ])
+
+            for categ in self.categs:
+                self.store.set_page_updated(categ, failed)
+
+            return (self.RUN, failed)
+
+    @staticmethod
+    def __try_lock(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def __is_fresh(self):
+        now = time.time()
+        return all([ now - self.store.get_page_updated(categ)[0] < self.fresh_window for categ in self.categs ])
+
+    def __get_failed(self):
+        return max([ self.store.get_page_updated(categ)[1] for categ in self.categs ])
+
+class ThreadFetchEngine(object):
+    """ Up to max_threads threads taking tasks in turn, joined against the run deadline.
+    The task deadline is left to the fetchers' request deadlines. """
+
+    def __init__(self, deadline=RUN_DEADLINE, max_threads=MAX_CONCURRENCY, task_deadline=TASK_DEADLINE):
+        self.deadline = deadline
+        self.max_threads = max_threads
+        self.task_deadline = task_deadline
+
+    def run(self, tasks):
+        results = [ None ] * len(tasks)
+        pending = collections.deque(enumerate(tasks))
+        end_tm = time.time() + self.deadline
+
+        threads = [ start_thread(self.__run_tasks, [pending, results, end_tm], daemon=True)
+                    for _ in range(min(self.max_threads, len(tasks))) ]
+
+        for thread in threads:
+            thread.join(max(0, end_tm - time.time()))
+
+        return [ result if result else TaskResult(task.name, task.url, False, "run deadline exceeded", self.deadline)
+                 for task, result in zip(tasks, results) ]
+
+    def __run_tasks(self, pending, results, end_tm):
+        while time.time() < end_tm:
+            try:
+                idx, task = pending.popleft()
+            except IndexError:
+                return
+
+            results[idx] = run_task(task)
+
+class AsyncFetchEngine(object):
+    """ asyncio scheduler with a global and a per-host concurrency cap.
+
+    The fetchers are blocking, so each task runs in an executor thread while
+    the event loop enforces the limits and the per-task and per-run deadlines.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, host_concurrency=HOST_CONCURRENCY,
+                 task_deadline=TASK_DEADLINE, deadline=RUN_DEADLINE):
+        self.max_concurrency = max_concurrency
+        self.host_concurrency = host_concurrency
+        self.task_deadline = task_deadline
+        self.deadline = deadline
+
+    def run(self, tasks):
+        import asyncio
+
+        if not tasks:
+            return []
+
+        return asyncio.run(self.__run(tasks))
+
+    async def __run(self, tasks):
+        import asyncio, concurrent.futures
+
+        executor = concurrent.futures.ThreadPoolExecutor(self.max_concurrency)
+        sem = asyncio.Semaphore(self.max_concurrency)
+        host_sems = collections.defaultdict(lambda: asyncio.Semaphore(self.host_concurrency))
+
+        futures = [ asyncio.ensure_future(self.__run_task(task, executor, sem, host_sems)) for task in tasks ]
+        done, pending = await asyncio.wait(futures, timeout=self.deadline)
+
+        for future in pending:
+            future.cancel()
+
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        return [ future.result() if future in done else TaskResult(task.name, task.url, False, "run deadline exceeded", self.deadline)
+                 for task, future in zip(tasks, futures) ]
+
+    async def __run_task(self, task, executor, sem, host_sems):
+        import asyncio
 
-    def __del__(self):
-        dirname = os.path.dirname(DB_NAME)
-        shutil.rmtree(dirname)
+        loop = asyncio.get_running_loop()
+        host = urllib.parse.urlsplit(task.url).netloc
+        start_tm = time.time()
+
+        # a task waiting for its host must not hold a global slot other hosts could use
+        async with host_sems[host], sem:
+            try:
+                return await asyncio.wait_for(loop.run_in_executor(executor, run_task, task), self.task_deadline)
+            except asyncio.TimeoutError:
+                logging.error("Task [%s] exceeded %d sec deadline" % (task.name, self.task_deadline))
+                return TaskResult(task.name, task.url, False, "task deadline exceeded", time.time() - start_tm)
+
+class ParsePool(object):
+    """ Processes running the fetchers' _get_data on the bodies the fetch threads download.
+
+    A fetch thread hands its body over and waits for the result, then stores
+    it like it would have after parsing in place, so results reach the store
+    as soon as each one is ready. At most PARSE_BACKLOG bodies per process
+    are in flight, beyond that the fetch threads wait before handing theirs
+    over instead of piling bodies up in memory. Neither wait outlasts the
+    fetcher's deadline.
+
+    The processes come from a MP_START_METHOD server, not from a fork of
+    this possibly threaded process. A one-shot run starts a pool per run,
+    the daemon keeps one for its lifetime.
+    """
+
+    def __init__(self, workers=PARSE_WORKERS, backlog=PARSE_BACKLOG):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers * backlog)
+        self.executor = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def start(self):
+        import concurrent.futures, multiprocessing
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.workers,
+                                                               mp_context=multiprocessing.get_context(MP_START_METHOD))
+        for future in [ self.executor.submit(prepare_parse_worker) for _ in range(self.workers) ]:
+            future.result()
+
+        return self
+
+    def close(self):
+        # queued bodies are dropped, the ones being parsed take well under a second
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def parse(self, fetcher, body):
+        import concurrent.futures
+
+        get_timeout = lambda: max(0, fetcher.deadline - time.time()) if fetcher.deadline else None
+
+        with fetcher.metrics.timed(RunMetrics.STAGE_PARSE_WAIT):
+            if not self.slots.acquire(timeout=get_timeout()):
+                raise concurrent.futures.TimeoutError("no parse process free before the deadline")
+
+        try:
+            future = self.executor.submit(parse_body, fetcher.__class__, fetcher.url, fetcher.parser, body)
+            data, seconds = future.result(get_timeout())
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise concurrent.futures.TimeoutError("parse of [%s] outlived the deadline" % (fetcher.url))
+        finally:
+            self.slots.release()
+
+        fetcher.metrics.add_span(RunMetrics.STAGE_PARSE, seconds)
+
+        return data
+
+class DatabaseUpdater(object):
+    def __init__(self, plan, cache=None, sessions=None, engine=None, parser=PARSER_AUTO, metrics=None, store=None,
+                 parse_workers=1, parse_pool=None):
+        self.plan = plan
+        self.cache = cache
+        self.sessions = sessions if sessions else SessionPool()
+        self.engine = engine if engine else AsyncFetchEngine()
+        self.parser = parser
+        self.metrics = metrics if metrics else RunMetrics()
+        self.store = store if store else ForecastStore()
+        self.archive = ForecastArchive(os.path.join(os.path.dirname(self.store.filepath), ARCHIVE_DIRNAME))
+        self.parse_workers = parse_workers
+        self.parse_pool = parse_pool # shared pool of a daemon, otherwise one is started per run
+        self.end_tm = 0
 
     def run(self):
-        check_to_create_parent_dir(DB_NAME)
-        self.db = shelve.open(DB_NAME, flag='c', writeback=True)
-        self.threads.append(start_thread(self.__fetch_jp_img))
+        self.end_tm = time.time() + self.engine.deadline
 
-        for categ in self.tgt_categs:
-            if not categ in INFOS_MAP:
-                continue
+        if not self.parse_pool and self.parse_workers > 1 and len(self.plan) > 1:
+            with ParsePool(self.parse_workers) as self.parse_pool:
+                results = self.engine.run(self.__get_tasks())
+            self.parse_pool = None
+        else:
+            results = self.engine.run(self.__get_tasks())
+
+        for result in results:
+            if not result.ok:
+                logging.error("Task [%s] failed: %s" % (result.name, result.error))
+
+            self.metrics.count("tasks", (("result", "ok" if result.ok else "failed"),))
+
+        logging.info("%d/%d fetch tasks succeeded." % (len([ r for r in results if r.ok ]), len(results)))
 
-            for info in INFOS_MAP[categ]:
-                logging.info("Fetch data for site [%s]." % (info.name))
+        return results
 
-                self.threads.append(start_thread(self.__fetch_wg_data, [info]))
-                self.threads.append(start_thread(self.__fetch_tide_data, [info]))
+    def __get_tasks(self):
+        tasks = []
+        funcs = { KEY_WG: self.__fetch_wg_data, KEY_TIDE: self.__fetch_tide_data, KEY_WEATHER: self.__fetch_weather_data }
 
-                if info.weather_url:
-                    self.threads.append(start_thread(self.__fetch_weather_data, [info]))
+        for item in self.plan:
+            if item.source == KEY_JP_IMG:
+                tasks.append(FetchTask(KEY_JP_IMG, JP_IMG_URL, self.__fetch_jp_img, ()))
+                continue
+
+            logging.info("Fetch %s for site [%s]." % (item.source, item.info.name))
+            tasks.append(FetchTask("%s/%s" % (item.info.name, item.source), getattr(item.info, SOURCE_URL_FIELDS[item.source]),
+                                   funcs[item.source], (item.info,)))
 
-        join_all_threads(self.threads)
-        self.db.close()
+        return tasks
 
     def __fetch_jp_img(self):
-        download_file(JP_IMG_URL, JP_IMG_FILE)
+        task = self.metrics.get_task(KEY_JP_IMG, KEY_JP_IMG)
+        download_file(JP_IMG_URL, JP_IMG_FILE, self.cache, JP_IMG_CACHE_TTL, self.sessions, task, self.__get_deadline())
+
+        with task.timed(RunMetrics.STAGE_PUBLISH):
+            entries = ChartPublisher().publish(JP_IMG_FILE)
+
+        self.__update_db(KEY_JP_IMG, KEY_JP_IMG, json.dumps(entries))
 
     def __fetch_wg_data(self, info):
-        data = WindGuruDataFetcher(info.wg_url).fetch()
-        logging.debug("wg_data: " + data)
-        self.__update_db(info.name, KEY_WG, data)
+        data = self.__new_fetcher(WindGuruDataFetcher, info.wg_url, info.name, KEY_WG).fetch()
+        logging.debug("wg_data: " + data['html'])
+        self.__update_db(info.name, KEY_WG, data['html'])
+
+        if data['fcst']:
+            fcst = data['fcst']
+            columns = ForecastColumns(fcst['model'], fcst['init_tm'], fcst['hours'], fcst['columns'])
+
+            with self.metrics.get_task(info.name, KEY_WG).timed(RunMetrics.STAGE_DB_WRITE):
+                self.store.put_columns(info.name, columns)
+                self.archive.append(info.name, KEY_WG, columns.init_tm, columns.get_times(), columns.columns)
 
     def __fetch_weather_data(self, info):
-        data = WeatherDataFetcher(info.weather_url).fetch()
+        data = self.__new_fetcher(WeatherDataFetcher, info.weather_url, info.name, KEY_WEATHER).fetch()
 
         logging.debug("weather_data: " + data)
         self.__update_db(info.name, KEY_WEATHER, data)
 
     def __fetch_tide_data(self, info):
-        data = ""
+        data = { 'html': "", 'tides': [] }
         url = info.tide_url
 
         if -1 != url.find(CWB_SITE):
-            data = CwbTideDataFetcher(url).fetch()
+            data = self.__new_fetcher(CwbTideDataFetcher, url, info.name, KEY_TIDE).fetch()
         elif -1 != url.find(MSW_SITE):
-            data = MswTideDataFetcher(url).fetch()
+            data = self.__new_fetcher(MswTideDataFetcher, url, info.name, KEY_TIDE).fetch()
         else:
             logging.error("Unknown tide url [%s]" % url)
 
-        logging.debug("tide_data: " + data)
-        self.__update_db(info.name, KEY_TIDE, data)
+        logging.debug("tide_data: " + data['html'])
+        self.__update_db(info.name, KEY_TIDE, data['html'])
+
+        if data['tides']:
+            with self.metrics.get_task(info.name, KEY_TIDE).timed(RunMetrics.STAGE_DB_WRITE):
+                self.store.put_tides(info.name, data['tides'])
+                self.archive.append(info.name, KEY_TIDE, int(time.time()), [ tm for tm, _ in data['tides'] ],
+                                    { "HIGH": [ 1.0 if is_high else 0.0 for _, is_high in data['tides'] ] })
+
+    def __new_fetcher(self, fetcher_cls, url, site_name, key):
+        return fetcher_cls(url, cache=self.cache, sessions=self.sessions, parser=self.parser,
+                           metrics=self.metrics.get_task(site_name, key), parse_pool=self.parse_pool,
+                           deadline=self.__get_deadline())
+
+    def __get_deadline(self):
+        """ Requests of a task starting now end with the task or with the run, whichever comes first """
+        return min(self.end_tm, time.time() + self.engine.task_deadline)
 
     def __update_db(self, site_name, key, data):
-        self.lock.acquire()
-        data_dict = self.db.setdefault(site_name, {})
-        data_dict[key] = data
-        self.lock.release()
+        with self.metrics.get_task(site_name, key).timed(RunMetrics.STAGE_DB_WRITE):
+            self.store.put(site_name, key, data)
+
+class SurfScorer(object):
+    """ Surf quality from 0 to 10 of every forecast step of every spot.
+
+    Swell height, period and direction, wind speed and direction relative to
+    the orientation of the beach, and the tide state are rated each from 0 to
+    1 and multiplied. Every rating is computed at once over (spots, steps)
+    arrays, padded with NaN where a spot has fewer steps.
+    """
+
+    # wave height (m) / peak period (s) -> rating, piecewise linear
+    HEIGHT_CURVE = ([ 0.3, 1.0, 2.0, 3.5 ], [ 0.0, 0.8, 1.0, 0.5 ])
+    PERIOD_CURVE = ([ 4.0, 7.0, 12.0 ], [ 0.2, 0.6, 1.0 ])
+    # wind (knots) stops mattering below the first speed, onshore wind is at its worst above the second
+    WIND_SPEEDS = (4.0, 20.0)
+    # mid tide rates 1, high and low tide rate 1 - TIDE_PENALTY
+    TIDE_PENALTY = 0.3
+
+    def __init__(self, store):
+        self.store = store
+
+    def get_sessions(self, infos, now=None):
+        """ Daylight steps from now on scoring at least MIN_SESSION_SCORE, best
+        first. None if numpy is not installed. """
+        try:
+            import numpy as np
+        except ImportError:
+            logging.warning("numpy is not installed, no session scoring")
+            return None
+
+        series = [ (info, self.store.get_columns(info.name)) for info in infos ]
+        infos = [ info for info, columns in series if columns ]
+        series = [ columns for info, columns in series if columns ]
+        if not infos:
+            return []
+
+        now = now if now else time.time()
+        steps = max([ len(columns) for columns in series ])
+
+        times = np.full((len(infos), steps), np.nan)
+        values = dict([ (name, np.full((len(infos), steps), np.nan, dtype=np.float32)) for name in WG_COLUMNS ])
+        tide = np.full((len(infos), steps), np.nan)
+
+        for idx, (info, columns) in enumerate(zip(infos, series)):
+            times[idx, :len(columns)] = np.asarray(columns.get_times(), dtype=np.float64)
+
+            for name in WG_COLUMNS:
+                values[name][idx, :len(columns)] = np.frombuffer(columns.get(name), dtype=np.float32)
+
+            tide[idx] = self.__get_tide_level(self.store.get_tides(info.name), times[idx])
+
+        # a spot without an orientation cannot be rated and scores 0
+        orientation = np.array([ np.nan if info.orientation is None else info.orientation for info in infos ],
+                               dtype=np.float64)[:, None]
+        scores = self.__get_scores(values, orientation, tide)
+
+        local_hours = ((times + LOCAL_UTC_OFFSET*60*60) // (60*60)) % 24
+        valid = ((times >= now - 3*60*60) & (local_hours >= SESSION_HOURS[0]) & (local_hours <= SESSION_HOURS[1]) &
+                 (scores >= MIN_SESSION_SCORE))
+
+        spot_idx, step_idx = np.nonzero(valid)
+        order = np.argsort(-scores[spot_idx, step_idx], kind='stable')
+
+        return [ self.__get_session(infos[i], times[i, j], scores[i, j], dict([ (name, values[name][i, j]) for name in WG_COLUMNS ]))
+                 for i, j in zip(spot_idx[order], step_idx[order]) ]
+
+    def __get_scores(self, values, orientation, tide):
+        import numpy as np
+
+        height = np.interp(values["HTSGW"], *self.HEIGHT_CURVE)
+        period = np.interp(values["PERPW"], *self.PERIOD_CURVE)
+        # swell from the direction the beach faces rates 1, from alongshore or behind 0
+        exposure = np.clip(np.cos(np.radians(values["DIRPW"] - orientation)), 0, 1)
+        swell = height * period * exposure
+
+        # 1 for offshore wind, blowing from the land behind the beach, -1 for onshore
+        offshore = np.cos(np.radians(values["WINDDIR"] - (orientation + 180)))
+        strength = np.clip((values["WINDSPD"] - self.WIND_SPEEDS[0]) / (self.WIND_SPEEDS[1] - self.WIND_SPEEDS[0]), 0, 1)
+        wind = 1 - strength * (1 - offshore) / 2
+
+        tide_rating = np.where(np.isnan(tide), 1, 1 - self.TIDE_PENALTY * np.abs(2*tide - 1))
+
+        return np.nan_to_num(10 * swell * wind * tide_rating, nan=0.0)
+
+    @staticmethod
+    def __get_tide_level(tides, times):
+        """ 0 at low tide, 1 at high tide, cosine interpolated between the
+        extremes around every time, NaN outside the tide table """
+        import numpy as np
+
+        if len(tides) < 2:
+            return np.full(times.shape, np.nan)
+
+        tides = sorted(tides)
+        tide_times = np.array([ tm for tm, _ in tides ], dtype=np.float64)
+        tide_highs = np.array([ high for _, high in tides ], dtype=np.float64)
+
+        idx = np.clip(np.searchsorted(tide_times, times, side='right'), 1, len(tides) - 1)
+        start, end = tide_times[idx - 1], tide_times[idx]
+        frac = np.clip((times - start) / np.maximum(end - start, 1), 0, 1)
+        level = tide_highs[idx - 1] + (tide_highs[idx] - tide_highs[idx - 1]) * (1 - np.cos(np.pi * frac)) / 2
+
+        return np.where((times < tide_times[0]) | (times > tide_times[-1]) | np.isnan(times), np.nan, level)
+
+    @staticmethod
+    def __get_session(info, tm, score, values):
+        local_tm = datetime.datetime.utcfromtimestamp(tm + LOCAL_UTC_OFFSET*60*60)
+        values = dict([ (name, None if math.isnan(value) else round(float(value), 1)) for name, value in values.items() ])
+
+        return {
+            'site': info.name,
+            'time': int(tm),
+            'local_time': local_tm.strftime("%m/%d %H:%M"),
+            'score': round(float(score), 1),
+            'wave_height': values["HTSGW"],
+            'wave_period': values["PERPW"],
+            'wave_dir': values["DIRPW"],
+            'wind_speed': values["WINDSPD"],
+            'gust': values["GUST"],
+            'wind_dir': values["WINDDIR"],
+        }
+
+class PageWriter(object):
+    """ Stream a page to its file and to precompressed variants next to it,
+    .gz always and .br when brotli is installed, for nginx gzip_static and
+    brotli_static. Every variant goes to a temporary file and all of them
+    are moved in place once the page is complete. """
+
+    GZIP_LEVEL = 9
+    BROTLI_QUALITY = 11
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.suffix = ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+        self.fds = []
+
+        check_to_create_parent_dir(filepath)
+
+        self.fd = self.__open("")
+        self.gzip = gzip.GzipFile(filename='', mode='wb', compresslevel=self.GZIP_LEVEL,
+                                  fileobj=self.__open(".gz"), mtime=0)
+        self.brotli = brotli.Compressor(quality=self.BROTLI_QUALITY) if brotli else None
+        self.brotli_fd = self.__open(".br") if brotli else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.commit()
+
+    def write(self, data):
+        self.fd.write(data)
+        self.gzip.write(data)
+
+        if self.brotli:
+            self.brotli_fd.write(self.brotli.process(data))
+
+    def commit(self):
+        self.gzip.close()
+
+        if self.brotli:
+            self.brotli_fd.write(self.brotli.finish())
+
+        for fd in self.fds:
+            fd.close()
+            os.replace(fd.name, fd.name[:-len(self.suffix)])
+
+        # A .br left by an earlier run with brotli would be served stale
+        if not self.brotli and os.path.exists(self.filepath + ".br"):
+            os.remove(self.filepath + ".br")
+
+    def abort(self):
+        for fd in self.fds:
+            fd.close()
+            os.remove(fd.name)
+
+    @staticmethod
+    def get_paths(filepath):
+        return [ filepath + ext for ext in ("", ".gz", ".br")[:3 if brotli else 2] ]
+
+    def __open(self, ext):
+        fd = open(self.filepath + ext + self.suffix, "wb")
+        self.fds.append(fd)
+        return fd
+
+class ChartPublisher(object):
+    """ Publish the downloaded JP chart as <name>.<sha1>.gif in JP_IMG_DIR, plus
+    a lossless .webp with every frame when Pillow is installed and the webp
+    comes out smaller. A published name never changes content, so it can be
+    cached forever and the pages link the newest one. The last
+    JP_IMG_HISTORY charts are listed in the manifest, newest first, and
+    older ones are deleted. """
+
+    def __init__(self, dirname=JP_IMG_DIR, history=JP_IMG_HISTORY):
+        self.dirname = dirname
+        self.history = history
+
+    def publish(self, filepath, published_at=None):
+        """ Returns the manifest entries, unchanged if the chart is already the newest """
+        with open(filepath, "rb") as fd:
+            content = fd.read()
+
+        digest = hashlib.sha1(content).hexdigest()[:16]
+        entries = self.get_entries()
+
+        if entries and entries[0]['hash'] == digest:
+            return entries
+
+        name = "%s.%s" % (os.path.splitext(os.path.basename(filepath))[0], digest)
+        entry = { 'hash': digest, 'time': int(published_at if published_at else time.time()), 'gif': name + ".gif" }
+        write_file_atomic(os.path.join(self.dirname, entry['gif']), content)
+
+        webp = self.__transcode(content)
+        if webp and len(webp) < len(content):
+            entry['webp'] = name + ".webp"
+            write_file_atomic(os.path.join(self.dirname, entry['webp']), webp)
+
+        entries = [ entry ] + [ old for old in entries if old['hash'] != digest ]
+        manifest = json.dumps(entries[:self.history], indent=1).encode('utf-8')
+        write_file_atomic(os.path.join(self.dirname, JP_IMG_MANIFEST), manifest)
+
+        # deleted only once the manifest no longer lists them
+        for old in entries[self.history:]:
+            for filename in [ old['gif'], old.get('webp') ]:
+                if filename and os.path.exists(os.path.join(self.dirname, filename)):
+                    os.remove(os.path.join(self.dirname, filename))
+
+        logging.info("Chart %s published (%d bytes gif, %s webp)" % (name, len(content),
+                                                                    len(webp) if 'webp' in entry else "no"))
+
+        return entries[:self.history]
+
+    def get_entries(self):
+        try:
+            with open(os.path.join(self.dirname, JP_IMG_MANIFEST), "rb") as fd:
+                return json.loads(fd.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return []
+
+    @staticmethod
+    def __transcode(content):
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+
+        try:
+            out = io.BytesIO()
+            Image.open(io.BytesIO(content)).save(out, "WEBP", lossless=True, method=6, save_all=True)
+            return out.getvalue()
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("Chart transcode failed: %s" % (e))
+            return None
 
 class HtmlCreater(object):
     HTML_START = r'''
@@ -356,15 +1896,14 @@ class HtmlCreater(object):
 	<script src="/js/forecasts.min.js"></script>
 	<script src="/js/wg_user_colors_json.js"></script>
 	<!-- <script src="/js/jquery-scrolltofixed-min.js"></script> -->
-	<script>
-	    //<![CDATA[
-var WgLang = {"legend":{"SMER":"Wind direction","TMP":"Temperature","WINDSPD":"Wind speed","MWINDSPD":"Modif. wind","APCP":"Rain (mm\/3h)","TCDC":"Cloud cover (%)","HTSGW":"Wave","WAVESMER":"Wave direction","RATING":"Windguru rating","PERPW":"Wave period (s)","APCP1":"Rain (mm\/1h)","GUST":"Wind gusts","SLP":"<span class=\"helpinfhpa\">*Pressure (hPa)<\/span>","RH":"Humidity (%)","FLHGT":"<span class=\"helpinffl\">*0\u00b0 isotherm (m)<\/span>","CDC":"Cloud cover (%)<br\/>high \/ mid \/ low","TMPE":"<span class=\"helpinftmp\">*Temperature <\/span>","WCHILL":"Wind chill","APCPs":"<span class=\"helpinfsnow\">*Precip. (mm\/3h)<\/span>","APCP1s":"<span class=\"helpinfsnow\">*Precip. (mm\/1h)<\/span>","WVHGT":"Wind wave","WVPER":"Wind wave per.(s)","WVDIR":"Wind wave dir.","SWELL1":"Swell","SWPER1":"Swell period (s)","SWDIR1":"Swell direction","SWELL2":"2.Swell","SWPER2":"2.Swell period (s)","SWDIR2":"2.Swell dir.","DIRPW":"Wave direction","WAVEDIR":"Wave direction"},"tooltip":{"TMPE":"Temperature at 2 meters above surface adjusted to real altitude of the spot. More info in Help\/FAQ section.","SLP":"Sea level pressure in hPa, values above 1000 hPa are printed <b>as x-1000<\/b>","FLHGT":"Freezing level height in meters","sst":"Sea surface temperature based on satellite data. Valid for oceans and large lakes, more info in help\/FAQ","APCP1s":"Precipitation in milimeters. Bold blue numbers indicate snowfall.","APCPs":"Precipitation in milimeters. Bold blue numbers indicate snowfall."},"dir":["N","NNE","NE","ENE","E","ESE","SE","SSE","S","SSW","SW","WSW","W","WNW","NW","NNW"],"weekday":["Su","Mo","Tu","We","Th","Fr","Sa"],"txt":{"archive":"Archive","tides":"Tides","detail":"Detail \/ Map","link":"Link","timezone":"Timezone","help":"Help","options":"Options","choose_m":"Choose wind modification","loading":"Loading forecast...","delayed":"12 hours delayed forecast. Latest MM5\/WRF forecasts are only available to Windguru PRO subscribers. <a href='help_index.php?sec=pro'>Click for more info.<\/a>","delayed_short":"12 hours delayed forecast. Latest MM5\/WRF forecasts are only available to Windguru PRO subscribers.","custom_onlypro":"MM5\/WRF forecasts for custom spots are only available to Windguru PRO users","lastupdated":"Last updated","nextexpected":"Next update expected","timeleft":"Time left"},"tab":{"forecast":"Forecast","graph":"<img src=\"\/images\/gricon.png\" width=\"15\" height=\"10\"\/>","2d":"2D","2d_t":"Temperature (0 ... 5000 m)","2d_w":"Wind (0 ... 5000 m)","2d_t_l":"Temperature (alt ... +2000 m)","2d_w_l":"Wind (alt ... +2000 m)","map":"Map","webcams":"Webcams","reports":"Wind reports","accommodation":"Accommodation","schools":"Schools\/Rentals","shops":"Shops","other":"Other...","directory":"Links","fcst_graph":"<img src=\"\/img\/gricon.png\"\/>","more":"<span class=\"butt-txt\">More<\/span>","statistic":"Statistics","archive":"Archive"},"units":{"kmh":"km\/h","mph":"mph","ms":"m\/s","msd":"m\/s","knots":"knots","bft":"Bft","c":"&deg;C","f":"&deg;F","m":"m","ft":"ft"},"maps":{"windspd":"Wind","t2m":"Temperature","press":"Pressure","tcdc_apcp3":"Rain \/ clouds","tcdc_apcp1":"Rain \/ clouds"},"mapsi":{"windspd":"wind","t2m":"temperature","press":"pressure","tcdc_apcp3":"precipitation","tcdc_apcp1":"precipitation"},"gmap":{"link_f":"Forecast","link_a":"Archive","link_d":"Detail","link_add":"Add to favourites","link_s":"Select"},"spotmenu":{"sel_zeme":"SELECT COUNTRY","sel_spot":"SELECT SPOT","num_spot":"spots","num_reg":"regions","num_zeme":"countries","sel_all":"ALL","qs_hint":"Type spot name (min. 3 characters)"},"langdir":{"dir":"int"}};
-//]]>
-    </script>
+	<script src="/js/wg_lang.js"></script>
   </head>
   <body>
 '''
-    HTML_JP_IMG = '<img src="%s" id="jp_img" alt="missing image"/>\n' % ("/" + JP_IMG_FILE)
+    HTML_JP_IMG = '<picture id="jp_chart" data-charts="%s">%s<img src="%s" id="jp_img" alt="missing image"/></picture>\n'
+    HTML_JP_WEBP = '<source srcset="%s" type="image/webp"/>'
+    HTML_CHART_NAV = ('<div class="chart-nav"><button id="chart_prev_btn" class="custom_btn">&lt;</button>'
+                      '<span id="chart_tm"></span><button id="chart_next_btn" class="custom_btn">&gt;</button></div>\n')
     HTML_NEXT_BTN = '<div id="next_btn" class="next_btn"></div>\n'
     HTML_BTNS_DIV = r'''<div class=button-grp>
 <button id="upd_btn" class="custom_btn">Update Data</button>
@@ -376,36 +1915,83 @@ var WgLang = {"legend":{"SMER":"Wind direction","TMP":"Temperature","WINDSPD":"W
   </body>
 </html>'''
 
-    def __init__(self, filename, categ):
+    HTML_HIDDEN_DIVS = ('<div id="mask"></div><div id="loading-icon"></div><div id="site-categ">%s</div>'
+                        '<div id="tw-categs">%s</div>')
+    HTML_LAST_UPD_TM = '<div class="last_upd_tm">%d</div>\n'
+    HTML_IMG_WITH_BTN = '<div class="img-with-btn">\n%s' + HTML_NEXT_BTN + '</div>\n' + HTML_CHART_NAV
+    HTML_SESSIONS = ('<div class="best-sessions"><table><caption>Best sessions</caption>\n'
+                     '<tr><th>Spot</th><th>Time</th><th>Score</th><th>Swell</th><th>Wind</th></tr>\n%s</table></div>\n')
+    HTML_SESSION_ROW = '<tr><td>%s</td><td>%s</td><td>%.1f</td><td>%sm %ss %s&deg;</td><td>%skn %s&deg;</td></tr>\n'
+    HTML_NO_SESSION_ROW = '<tr><td colspan="5">No surfable session in the forecast.</td></tr>\n'
+
+    # Static markup is encoded once, its hash is part of every page hash so a
+    # template change rerenders all pages
+    PAGE_START = HTML_START.encode('utf-8')
+    PAGE_END = (HTML_BTNS_DIV + HTML_END).encode('utf-8')
+    TEMPLATE_HASH = hashlib.sha1(PAGE_START + PAGE_END +
+                                 (HTML_HIDDEN_DIVS + HTML_LAST_UPD_TM + HTML_SESSIONS + HTML_SESSION_ROW +
+                                  HTML_NO_SESSION_ROW + HTML_JP_IMG + HTML_JP_WEBP + HTML_IMG_WITH_BTN).encode('utf-8')).hexdigest()
+
+    PAGE_SOURCES = (KEY_WG, KEY_WEATHER, KEY_TIDE)
+
+    def __init__(self, filename, categ, metrics=None, store=None, sessions=None, hashes=None):
         self.filename = filename
         self.categ = categ
+        self.metrics = metrics if metrics else RunMetrics()
+        self.store = store if store else ForecastStore()
+        self.hashes = hashes # ForecastStore.get_all_hashes(), loaded once for all categories
+        self.sessions_html = self.__get_sessions_html(sessions) if sessions is not None else ""
 
     def run(self):
-        check_to_create_parent_dir(self.filename)
+        """ Returns False if the page content is unchanged and nothing was written. """
+        task = self.metrics.get_task(self.categ, "page")
+        page_hash = self.get_page_hash()
+
+        if page_hash == self.store.get_page_hash(self.categ) and \
+           all([ os.path.exists(filepath) for filepath in PageWriter.get_paths(self.filename) ]):
+            task.count("pages", result="unchanged")
+            return False
 
-        with io.open(self.filename, "w", encoding='utf-8') as fd, shelve.open(DB_NAME, 'r') as db:
-            fd.write(self.HTML_START)
-            self.__write_hidden_divs(fd)
-            self.__write_content(fd, db)
-            self.__write_buttons(fd)
-            fd.write(self.HTML_END)
+        with task.timed(RunMetrics.STAGE_RENDER), PageWriter(self.filename) as writer:
+            writer.write(self.PAGE_START)
+            writer.write((self.HTML_HIDDEN_DIVS % (self.categ, " ".join(SITE_CATEG_TW))).encode('utf-8'))
+            self.__write_content(writer)
+            writer.write(self.PAGE_END)
 
-    def __write_hidden_divs(self, fd):
-        fd.write('<div id="mask"></div>')
-        fd.write('<div id="loading-icon"></div>')
-        fd.write('<div id="site-categ">%s</div>' % (self.categ))
+        self.store.set_page_hash(self.categ, page_hash)
+        task.count("pages", result="written")
 
-    def __write_content(self, fd, db):
-        utc = datetime.datetime.utcnow()
-        fd.write('<div class="last_upd_tm">%d</div>\n' % (utc.timestamp()))
+        return True
+
+    def get_page_hash(self):
+        """ Everything on the page but the update time: the template and the
+        hashes of the stored fragments, in page order. """
+        sha1 = hashlib.sha1(("%s %s %s\n" % (self.TEMPLATE_HASH, self.categ, " ".join(SITE_CATEG_TW))).encode('utf-8'))
+        sha1.update(self.sessions_html.encode('utf-8'))
+
+        for info in INFOS_MAP.get(self.categ, []):
+            hashes = self.hashes.get(info.name, {}) if self.hashes is not None else self.store.get_hashes(info.name)
+
+            for key in self.PAGE_SOURCES:
+                sha1.update(("%s %s %s\n" % (info.name, key, hashes.get(key, ''))).encode('utf-8'))
 
         if self.categ in SITE_CATEG_TW:
-            fd.write('<div class="img-with-btn">\n')
-            fd.write(self.HTML_JP_IMG)
-            fd.write(self.HTML_NEXT_BTN)
-            fd.write('</div>\n')
+            hashes = self.hashes.get(KEY_JP_IMG, {}) if self.hashes is not None else self.store.get_hashes(KEY_JP_IMG)
+            sha1.update(("%s %s\n" % (KEY_JP_IMG, hashes.get(KEY_JP_IMG, ''))).encode('utf-8'))
 
-        logging.info("jp_img download complete.")
+        return sha1.hexdigest()
+
+    @staticmethod
+    def get_last_upd_tm():
+        return int(datetime.datetime.utcnow().timestamp())
+
+    def __write_content(self, writer):
+        writer.write((self.HTML_LAST_UPD_TM % (self.get_last_upd_tm())).encode('utf-8'))
+
+        if self.categ in SITE_CATEG_TW:
+            writer.write((self.HTML_IMG_WITH_BTN % (self.__get_chart_html())).encode('utf-8'))
+
+        writer.write(self.sessions_html.encode('utf-8'))
 
         if not self.categ in INFOS_MAP:
             return
@@ -413,46 +1999,449 @@ var WgLang = {"legend":{"SMER":"Wind direction","TMP":"Temperature","WINDSPD":"W
         for info in INFOS_MAP[self.categ]:
             logging.info("Writting data of [%s]" % (info.name))
 
-            data = db[info.name]
+            for key in self.PAGE_SOURCES:
+                row = self.store.get(info.name, key)
+
+                if row:
+                    writer.write(row.payload.encode('utf-8'))
+                elif key != KEY_WEATHER or info.weather_url:
+                    logging.warning("No %s for [%s], skipped" % (key, info.name))
+
+    def __get_chart_html(self):
+        """ The newest published chart, the others are listed for the prev/next view.
+        Falls back to the plain download until a chart is published. """
+        row = self.store.get(KEY_JP_IMG, KEY_JP_IMG)
+
+        try:
+            entries = json.loads(row.payload) if row else []
+        except ValueError:
+            entries = []
+
+        if not entries:
+            return self.HTML_JP_IMG % ("[]", "", "/" + JP_IMG_FILE)
+
+        get_url = lambda name: "/%s/%s" % (JP_IMG_DIR, name)
+        charts = [ dict([ ('time', entry['time']), ('gif', get_url(entry['gif'])) ] +
+                        ([ ('webp', get_url(entry['webp'])) ] if 'webp' in entry else []))
+                   for entry in entries ]
+        source = self.HTML_JP_WEBP % (charts[0]['webp']) if 'webp' in charts[0] else ""
+
+        return self.HTML_JP_IMG % (html.escape(json.dumps(charts)), source, charts[0]['gif'])
+
+    def __get_sessions_html(self, sessions):
+        fmt = lambda value: "-" if value is None else "%g" % (value)
+        rows = [ self.HTML_SESSION_ROW % (session['site'], session['local_time'], session['score'],
+                                          fmt(session['wave_height']), fmt(session['wave_period']), fmt(session['wave_dir']),
+                                          fmt(session['wind_speed']), fmt(session['wind_dir']))
+                 for session in sessions ]
+
+        return self.HTML_SESSIONS % ("".join(rows) if rows else self.HTML_NO_SESSION_ROW)
+
+
+class RefreshDaemon(object):
+    """ Resident refresher, configured by the parsed command line.
+
+    Every fragment is refreshed when it gets older than its source's
+    SOURCE_CADENCE, and a category can be refreshed on demand through the
+    control socket. Cache, sessions and store live as long as the daemon, so
+    kept-alive connections and parsed data are reused across runs.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.cache = None if args.no_cache else ResponseCache()
+        self.sessions = SessionPool(args.pool_size)
+        self.store = ForecastStore()
+        # shared by scheduled and on-demand runs, so neither retries a failing fragment too soon
+        self.planner = RefreshPlanner(self.store, retry_interval=SCHEDULE_MAX_SLEEP)
+        self.parse_pool = ParsePool(args.parse_workers) if args.parse_workers > 1 else None
+        self.run_lock = threading.Lock()
+
+    def run(self):
+        """ Serve until interrupted, returns False without serving if another daemon owns the socket """
+        if os.path.exists(self.args.sock_path):
+            if is_daemon_alive(self.args.sock_path):
+                logging.error("A daemon is already listening on [%s]" % (self.args.sock_path))
+                return False
+
+            # left behind by a daemon that did not shut down cleanly
+            os.remove(self.args.sock_path)
+
+        if self.parse_pool:
+            self.parse_pool.start()
+
+        server = socketserver.ThreadingUnixStreamServer(self.args.sock_path, ControlRequestHandler)
+        server.daemon_threads = True
+        server.refresher = self
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        start_thread(self.__schedule, daemon=True)
+        logging.info("Daemon listening on [%s]" % (self.args.sock_path))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(self.args.sock_path)
+            self.sessions.close()
+
+            if self.parse_pool:
+                self.parse_pool.close()
+
+        return True
+
+    def refresh(self, categs, sources=SOURCE_ALL):
+        with self.run_lock:
+            return run_update(self.args, categs, sources, self.cache, self.sessions, self.store, parse_pool=self.parse_pool,
+                              planner=self.planner)
 
-            fd.write(data[KEY_WG])
-            if KEY_WEATHER in data: fd.write(data[KEY_WEATHER])
-            fd.write(data[KEY_TIDE])
+    def request_refresh(self, categs):
+        """ On-demand refresh, coalesced with requests already in flight """
+        return RunCoalescer(categs, self.store, self.args.fresh_window).run(lambda: self.refresh(categs))
 
-    def __write_buttons(self, fd):
-        fd.write(self.HTML_BTNS_DIV)
+    def __schedule(self):
+        while True:
+            if self.planner.get_next_due(SITE_CATEG_ALL) <= time.time():
+                logging.info("Scheduled refresh")
+
+                try:
+                    # never skipped as fresh, but on-demand requests join it and see it in pages.updated_at
+                    RunCoalescer(SITE_CATEG_ALL, self.store, 0).run(lambda: self.refresh(SITE_CATEG_ALL))
+                except Exception:
+                    logging.error(traceback.format_exc())
+
+            # failed fragments are planned again SCHEDULE_MAX_SLEEP after their last attempt,
+            # only the ones deferred by host budgets are due right away
+            time.sleep(min(SCHEDULE_MAX_SLEEP, max(1, self.planner.get_next_due(SITE_CATEG_ALL) - time.time())))
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    """ One line per request: "refresh <categ|all>" -> "ok <seconds> <failed tasks> <run|joined|fresh>"
+    or "error <reason>" """
+
+    def handle(self):
+        words = self.rfile.readline(256).decode('utf-8', errors='replace').split()
+
+        if words == [ "ping" ]:
+            self.__reply("ok")
+            return
+
+        if len(words) != 2 or words[0] != "refresh" or not words[1] in SITE_CATEG_ALL + [ "all" ]:
+            self.__reply("error bad request")
+            return
+
+        categs = SITE_CATEG_ALL if words[1] == "all" else [ words[1] ]
+        start_tm = time.time()
+        logging.info("Refresh of [%s] requested" % (words[1]))
+
+        try:
+            how, failed = self.server.refresher.request_refresh(categs)
+            self.__reply("ok %.2f %d %s" % (time.time() - start_tm, failed, how))
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            self.__reply("error %s" % (e))
+
+    def __reply(self, line):
+        self.wfile.write((line + "\n").encode('utf-8'))
+
+class ApiCache(object):
+    """ API responses built from the store, served from memory for up to
+    API_CACHE_TTL seconds and then rebuilt. A response keeps its sha1 as its
+    strong ETag until its content changes, and is gzipped once when built.
+
+    /api/categs/<categ>                 {site: {source: sha1 of the fragment}}
+    /api/categs/<categ>/sessions        ranked sessions, as in SESSIONS_FILE
+    /api/sites/<site>/forecast          forecast columns and tide extremes
+    /api/sites/<site>/<source>          html fragment of KEY_WG, KEY_TIDE or KEY_WEATHER
+    """
+
+    CONTENT_JSON = "application/json"
+    CONTENT_HTML = "text/html; charset=utf-8"
+
+    def __init__(self, store=None, ttl=API_CACHE_TTL):
+        # one connection for every client thread, loads take turns on it
+        self.store = store if store else ForecastStore(shared=True)
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.infos = dict([ (info.name, info) for infos in INFOS_MAP.values() for info in infos ])
+
+    def get(self, path):
+        """ ApiResponse of path, None if there is no such resource """
+        words = [ word for word in path.split("/") if word ]
+        key = "/".join(words) # every spelling of a resource shares one entry
+
+        entry = self.entries.get(key)
+        if entry and time.time() - entry.loaded_at < self.ttl:
+            return entry
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry.loaded_at < self.ttl:
+                return entry
+
+            content = self.__load(words)
+            if content is None:
+                self.entries.pop(key, None)
+                return None
+
+            content_type, body = content
+            entry = ApiResponse(hashlib.sha1(body).hexdigest(), content_type, body,
+                                gzip.compress(body, mtime=0) if len(body) >= API_GZIP_MIN_SIZE else None, time.time())
+            self.entries[key] = entry
+
+        return entry
+
+    def __load(self, words):
+        if len(words) == 3 and words[:2] == [ "api", "categs" ] and words[2] in INFOS_MAP:
+            manifest = dict([ (info.name, self.store.get_hashes(info.name)) for info in INFOS_MAP[words[2]] ])
+            return self.__json(manifest)
+
+        if len(words) == 4 and words[:2] == [ "api", "categs" ] and words[2] in INFOS_MAP and words[3] == "sessions":
+            sessions = SurfScorer(self.store).get_sessions(INFOS_MAP[words[2]])
+            return self.__json(sessions[:BEST_SESSIONS]) if sessions is not None else None
+
+        if len(words) != 4 or words[:2] != [ "api", "sites" ] or not words[2] in self.infos:
+            return None
+
+        site, source = words[2:]
+
+        if source == "forecast":
+            columns = self.store.get_columns(site)
+            if not columns:
+                return None
+
+            nullable = lambda values: [ None if math.isnan(value) else round(value, 2) for value in values ]
+            return self.__json({ 'site': site, 'model': columns.model, 'init_tm': columns.init_tm,
+                                 'times': columns.get_times(),
+                                 'columns': dict([ (name, nullable(values)) for name, values in columns.columns.items() ]),
+                                 'tides': self.store.get_tides(site) })
+
+        row = self.store.get(site, source) if source in SOURCE_URL_FIELDS else None
+        return (self.CONTENT_HTML, row.payload.encode('utf-8')) if row else None
+
+    def __json(self, data):
+        return (self.CONTENT_JSON, json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+class ApiRequestHandler(socketserver.StreamRequestHandler):
+    """ Just enough HTTP/1.1 for GET and HEAD of ApiCache responses over
+    keep-alive connections: strong ETags, 304 on If-None-Match, gzip.
+
+    Without a query the response must be revalidated (Cache-Control no-cache).
+    With ?v=<sha1> matching the current content it is immutable, which is how
+    the page can fetch fragments listed in a categ manifest.
+    """
+
+    timeout = API_IDLE_TIMEOUT
+    disable_nagle_algorithm = True
+    MAX_LINE = 8192
+    MAX_HEADERS = 100
+    CACHE_CONTROL = "no-cache"
+    CACHE_CONTROL_VERSIONED = "public, max-age=31536000, immutable"
+
+    def handle(self):
+        try:
+            while self.__handle_request():
+                pass
+        except (socket.timeout, ConnectionError):
+            pass
+
+    def __handle_request(self):
+        line = self.rfile.readline(self.MAX_LINE + 1)
+        if not line:
+            return False
+
+        words = line.decode('latin-1').split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            self.__reply(400, "Bad Request", False)
+            return False
+
+        method, target, version = words
+        headers = {}
+
+        for _ in range(self.MAX_HEADERS):
+            line = self.rfile.readline(self.MAX_LINE + 1)
+            if line in (b"\r\n", b"\n", b""):
+                break
+
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            self.__reply(431, "Request Header Fields Too Large", False)
+            return False
+
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+        if not method in ("GET", "HEAD"):
+            self.__reply(405, "Method Not Allowed", keep_alive, [ ("Allow", "GET, HEAD") ])
+            return keep_alive
+
+        path, _, query = target.partition("?")
+        entry = self.server.api.get(path)
+
+        if not entry:
+            self.__reply(404, "Not Found", keep_alive)
+            return keep_alive
+
+        use_gzip = entry.gzip_body is not None and "gzip" in headers.get("accept-encoding", "")
+        etag = '"%s%s"' % (entry.content_hash, "-gz" if use_gzip else "")
+        versioned = ("v=" + entry.content_hash) in query.split("&")
+        resp_headers = [ ("ETag", etag), ("Cache-Control", self.CACHE_CONTROL_VERSIONED if versioned else self.CACHE_CONTROL),
+                         ("Vary", "Accept-Encoding") ]
+
+        if etag in [ tag.strip().replace("W/", "", 1) for tag in headers.get("if-none-match", "").split(",") ] or \
+           headers.get("if-none-match") == "*":
+            self.__reply(304, "Not Modified", keep_alive, resp_headers, None)
+            return keep_alive
+
+        resp_headers.append(("Content-Type", entry.content_type))
+        if use_gzip:
+            resp_headers.append(("Content-Encoding", "gzip"))
+
+        body = entry.gzip_body if use_gzip else entry.body
+        self.__reply(200, "OK", keep_alive, resp_headers, body, method == "HEAD")
+
+        return keep_alive
+
+    def __reply(self, code, reason, keep_alive, headers=(), body=b"", head_only=False):
+        lines = [ "HTTP/1.1 %d %s" % (code, reason) ] + [ "%s: %s" % (name, value) for name, value in headers ]
+
+        if body is not None:
+            lines.append("Content-Length: %d" % (len(body)))
+
+        lines.append("Connection: %s" % ("keep-alive" if keep_alive else "close"))
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+        self.wfile.write(head if head_only or not body else head + body)
+
+class ApiHTTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, addr, api):
+        socketserver.ThreadingTCPServer.__init__(self, addr, ApiRequestHandler)
+        self.api = api
 
 
 #########################
 ##    UTIL_FUCTIONS    ##
 #########################
 
-def start_thread(func, args=()):
-    thread = threading.Thread(target=func, args=args)
+def start_thread(func, args=(), daemon=False):
+    thread = threading.Thread(target=func, args=args, daemon=daemon)
     thread.start()
 
     return thread
 
-def join_all_threads(threads):
-    for thread in threads:
-        thread.join()
+def run_task(task):
+    start_tm = time.time()
+
+    try:
+        task.func(*task.args)
+        return TaskResult(task.name, task.url, True, "", time.time() - start_tm)
+    except Exception as e:
+        logging.debug(traceback.format_exc())
+        return TaskResult(task.name, task.url, False, "%s: %s" % (type(e).__name__, e), time.time() - start_tm)
+
+def prepare_parse_worker():
+    """ Load the parsing modules in a ParsePool process ahead of the first body """
+    import bs4
+    get_parser_backend(PARSER_AUTO)
+
+def parse_body(fetcher_cls, url, parser, body):
+    """ ParsePool process side, returns (data, seconds spent) """
+    start_tm = time.perf_counter()
+    data = fetcher_cls(url, parser=parser).parse(body)
+
+    return data, time.perf_counter() - start_tm
+
+def get_nearest_date(month_day, today):
+    """ "09/20(星期三)" -> the date with that month/day nearest to today """
+    month, day = int(month_day[0:2]), int(month_day[3:5])
+    dates = []
+
+    for year in (today.year - 1, today.year, today.year + 1):
+        try:
+            dates.append(datetime.date(year, month, day))
+        except ValueError: # 02/29
+            pass
+
+    return min(dates, key=lambda date: abs(date - today))
+
+def get_local_timestamp(date, time_txt, time_fmt):
+    """ UTC timestamp of a local date (ISO) and time of day, at LOCAL_UTC_OFFSET """
+    tm = datetime.datetime.strptime("%s %s" % (date, time_txt.strip()), "%Y-%m-%d " + time_fmt)
+    return int(tm.replace(tzinfo=datetime.timezone(datetime.timedelta(hours=LOCAL_UTC_OFFSET))).timestamp())
+
+def get_tide(date, time_txt, time_fmt, is_high):
+    """ [timestamp, is_high] of a tide table row, None if its time does not parse.
+    Tides only feed the session scores, a row they cannot use still goes on the page. """
+    try:
+        return [ get_local_timestamp(date, time_txt, time_fmt), is_high ]
+    except ValueError:
+        logging.warning("Skip tide at unparsable time [%s] on [%s]" % (time_txt.strip(), date))
+        return None
 
 def check_to_create_parent_dir(filepath):
     dirname = os.path.dirname(filepath)
     if dirname:
         os.makedirs(dirname, exist_ok=True)
 
-def download_file(url, filepath):
-    resp = requests.get(url)
-    resp.raise_for_status()
+def write_file_atomic(filepath, content):
+    check_to_create_parent_dir(filepath)
+    filepath_tmp = "%s.%d.%d.tmp" % (filepath, os.getpid(), threading.get_ident())
+
+    with open(filepath_tmp, "wb") as fd:
+        fd.write(content)
+
+    os.replace(filepath_tmp, filepath)
+
+def download_file(url, filepath, cache=None, ttl=0, sessions=None, metrics=None, deadline=None):
+    import requests
 
-    dirpath = os.path.dirname(filepath)
-    if dirpath:
-        os.makedirs(dirpath, exist_ok=True)
+    if not sessions:
+        sessions = SessionPool()
 
-    with open(filepath, "wb") as fd:
-        for chunk in resp.iter_content(CHUNK_SIZE):
-            fd.write(chunk)
+    if not metrics:
+        metrics = RunMetrics().get_task("", "")
+
+    if not cache:
+        resp = sessions.get(url, metrics=metrics, deadline=deadline)
+        resp.raise_for_status()
+        check_to_create_parent_dir(filepath)
+
+        with open(filepath, "wb") as fd:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                fd.write(chunk)
+        return
+
+    entry = cache.load(url)
+    has_file = os.path.exists(filepath)
+
+    if entry and has_file and entry.is_fresh(ttl):
+        logging.debug("Cache hit [%s]" % (url))
+        metrics.count("cache", result="hit")
+        return
+
+    headers = entry.get_validators() if entry and has_file else {}
+    resp = sessions.get(url, metrics=metrics, deadline=deadline, headers=headers)
+
+    if resp.status_code == requests.codes.not_modified:
+        logging.debug("Not modified [%s]" % (url))
+        metrics.count("cache", result="not_modified")
+        entry.fetched_at = time.time()
+    else:
+        resp.raise_for_status()
+        metrics.count("cache", result="miss")
+        changed = not entry or entry.body_hash != hashlib.sha1(resp.content).hexdigest()
+        entry = cache.update(url, entry, resp)
+
+        if changed or not has_file:
+            write_file_atomic(filepath, resp.content)
+
+    cache.save(entry)
 
 ################
 ##    MAIN    ##
@@ -460,16 +2449,44 @@ def download_file(url, filepath):
 
 def main():
     init_logger()
-    (workdir, cleanup, categs) = parse_args()
+    args = parse_args()
 
-    if workdir:
-        os.chdir(workdir)
+    if args.workdir:
+        os.chdir(args.workdir)
 
-    if cleanup == True:
+    if args.cleanup == True:
         do_cleanup()
         sys.exit(0)
 
-    update_html_files(categs)
+    if args.request:
+        sys.exit(0 if request_refresh(args.sock_path, args.categ if args.categ else "all") else 1)
+
+    if args.daemon:
+        sys.exit(0 if RefreshDaemon(args).run() else 1)
+
+    if args.serve:
+        serve_api(args.serve)
+        return
+
+    if args.archive_maintain:
+        ForecastArchive().maintain()
+        return
+
+    if args.render_only:
+        store = ForecastStore()
+        render_html_files(args.categs, store=store)
+        store.close()
+        return
+
+    sessions = SessionPool(args.pool_size)
+    store = ForecastStore()
+    cache = None if args.no_cache else ResponseCache()
+
+    try:
+        RunCoalescer(args.categs, store, args.fresh_window).run(
+            lambda: run_update(args, args.categs, SOURCE_ALL, cache, sessions, store, args.force))
+    finally:
+        sessions.close()
 
 def init_logger(filename=None):
     if filename:
@@ -488,17 +2505,52 @@ def parse_args():
                         help="set location target (all will be updated if not set)")
     parser.add_argument("-C", "--cleanup", action="store_true", default=False,
                         help="cleanup all download content")
+    parser.add_argument("-n", "--no-cache", action="store_true", default=False,
+                        help="ignore the http response cache and download everything")
+    parser.add_argument("-p", "--pool-size", type=int, default=POOL_SIZE,
+                        help="max keep-alive connections per upstream host")
+    parser.add_argument("-e", "--engine", default=ENGINE_ASYNCIO, choices=ENGINE_ALL,
+                        help="fetch engine (threads are kept as a fallback)")
+    parser.add_argument("-j", "--concurrency", type=int, default=MAX_CONCURRENCY,
+                        help="max fetch tasks in flight per worker")
+    parser.add_argument("-W", "--workers", type=int, default=WORKERS,
+                        help="fetch in this many processes, each one owning a share of the upstream hosts")
+    parser.add_argument("-J", "--parse-workers", type=int, default=PARSE_WORKERS,
+                        help="parse the downloaded pages in this many processes, 1 parses in the fetch threads")
+    parser.add_argument("-d", "--deadline", type=float, default=RUN_DEADLINE,
+                        help="seconds allowed for fetching before the run gives up")
+    parser.add_argument("-P", "--parser", default=PARSER_AUTO, choices=PARSER_ALL,
+                        help="html parser backend (auto prefers lxml when installed)")
+    parser.add_argument("--trace-file", default=TRACE_FILE,
+                        help="write per-stage timings of the run as JSON ('' to disable)")
+    parser.add_argument("--prom-file", default=PROM_FILE,
+                        help="write run metrics in prometheus text format ('' to disable)")
+    parser.add_argument("-D", "--daemon", action="store_true", default=False,
+                        help="stay resident, refresh sources on schedule and serve the control socket")
+    parser.add_argument("-r", "--request", action="store_true", default=False,
+                        help="ask a running daemon to refresh the category and wait for it")
+    parser.add_argument("-s", "--sock-path", default=SOCK_PATH, help="daemon control socket")
+    parser.add_argument("-F", "--force", action="store_true", default=False,
+                        help="refetch every source, even the ones still within their upstream cadence")
+    parser.add_argument("-f", "--fresh-window", type=float, default=FRESH_WINDOW,
+                        help="skip the update if the categories were updated within this many seconds")
+    parser.add_argument("-R", "--render-only", action="store_true", default=False,
+                        help="regenerate the pages from stored data without fetching anything")
+    parser.add_argument("-S", "--serve", nargs="?", const=API_ADDR, default="", metavar="[HOST:]PORT",
+                        help="serve fragments and forecasts from the store over http (default %s)" % (API_ADDR))
+    parser.add_argument("--archive-maintain", action="store_true", default=False,
+                        help="compact and expire the old months of the forecast archive")
 
     args = parser.parse_args()
-    categs = [ args.categ ] if args.categ else SITE_CATEG_ALL
+    args.categs = [ args.categ ] if args.categ else SITE_CATEG_ALL
 
     logging.info("args: [%s]" % (str(args)))
 
-    return (args.workdir, args.cleanup, categs)
+    return args
 
 def do_cleanup():
-    dirs = SITE_CATEG_ALL
-    files = [ DB_NAME, JP_IMG_FILE ]
+    dirs = SITE_CATEG_ALL + [ CACHE_DIR, JP_IMG_DIR ]
+    files = [ DB_NAME, DB_NAME + "-wal", DB_NAME + "-shm", JP_IMG_FILE ]
 
     logging.info("Cleanup dirs: %s" % ", ".join(dirs))
 
@@ -513,18 +2565,157 @@ def do_cleanup():
         except:
             pass
 
-def update_html_files(categs):
-    db_updater = DatabaseUpdater(categs)
-    db_updater.run()
+def request_refresh(sock_path, categ):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CONTROL_TIMEOUT)
+        sock.connect(sock_path)
+        sock.sendall(("refresh %s\n" % (categ)).encode('utf-8'))
+        reply = sock.makefile(encoding='utf-8').readline().strip()
+
+    logging.info("Daemon replied [%s]" % (reply))
+
+    return reply.startswith("ok")
+
+def is_daemon_alive(sock_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CONTROL_TIMEOUT)
+
+        try:
+            sock.connect(sock_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+
+        try:
+            sock.sendall("ping\n".encode('utf-8'))
+            reply = sock.makefile(encoding='utf-8').readline().strip()
+        except OSError:
+            # accepted but silent, something still owns the socket
+            return True
+
+    logging.info("Daemon on [%s] replied [%s]" % (sock_path, reply))
+
+    return True
+
+def serve_api(addr):
+    host, _, port = addr.rpartition(":")
+    server = ApiHTTPServer((host if host else "127.0.0.1", int(port)), ApiCache())
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    logging.info("Serving the API on [%s:%d]" % (server.server_address[0], server.server_address[1]))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def get_engine(args):
+    if args.engine == ENGINE_THREAD:
+        return ThreadFetchEngine(args.deadline, args.concurrency)
+    else:
+        return AsyncFetchEngine(args.concurrency, deadline=args.deadline)
+
+def run_update(args, categs, sources, cache, sessions, store=None, force=False, parse_pool=None, planner=None):
+    """ update_html_files, with the run metrics exported where args says """
+    metrics = RunMetrics()
+
+    try:
+        return update_html_files(categs, cache, sessions, get_engine(args), args.parser, metrics, store, sources, force,
+                                 args.workers, args.parse_workers, parse_pool, planner)
+    finally:
+        metrics.finish()
+
+        if args.trace_file:
+            metrics.write_trace(args.trace_file)
+        if args.prom_file:
+            metrics.write_prometheus(args.prom_file)
+
+def update_html_files(categs, cache=None, sessions=None, engine=None, parser=PARSER_AUTO, metrics=None, store=None,
+                      sources=SOURCE_ALL, force=False, workers=WORKERS, parse_workers=PARSE_WORKERS, parse_pool=None,
+                      planner=None):
+    store = store if store else ForecastStore()
+    metrics = metrics if metrics else RunMetrics()
+    plan = (planner if planner else RefreshPlanner(store)).plan(categs, sources, force)
+
+    logging.info("%d fragments to refetch" % (len(plan)))
+
+    if workers > 1 and len(plan) > 1:
+        results = run_shards(RefreshPlanner.shard(plan, workers), cache, engine, parser, metrics, store, parse_workers)
+    else:
+        db_updater = DatabaseUpdater(plan, cache, sessions, engine, parser, metrics, store, parse_workers, parse_pool)
+        results = db_updater.run()
+
+    render_html_files(categs, metrics, store)
+
+    return results
+
+def run_shards(shards, cache, engine, parser, metrics, store, parse_workers=1):
+    """ DatabaseUpdater over every shard of a plan, each in its own process.
+    The parse processes are split between the shards. """
+    import concurrent.futures, multiprocessing
+
+    results = []
+    shard_parse_workers = max(1, parse_workers // len(shards))
+
+    with concurrent.futures.ProcessPoolExecutor(len(shards), mp_context=multiprocessing.get_context(MP_START_METHOD)) as executor:
+        futures = [ executor.submit(run_shard, shard, cache, engine, parser, store.filepath, shard_parse_workers)
+                    for shard in shards ]
+
+        for future in futures:
+            shard_results, start_tm, spans, counters = future.result()
+            results.extend(shard_results)
+            metrics.merge(start_tm, spans, counters)
+
+    logging.info("%d/%d fetch tasks succeeded in %d workers." % (len([ r for r in results if r.ok ]), len(results), len(shards)))
+
+    return results
+
+def run_shard(plan, cache, engine, parser, store_file, parse_workers=1):
+    """ Worker process side of run_shards, with its own sessions and store connection """
+    metrics = RunMetrics()
+    sessions = SessionPool()
+    store = ForecastStore(store_file)
+
+    try:
+        results = DatabaseUpdater(plan, cache, sessions, engine, parser, metrics, store, parse_workers).run()
+    finally:
+        sessions.close()
+        store.close()
+
+    return results, metrics.start_tm, metrics.spans, metrics.counters
+
+def render_html_files(categs, metrics=None, store=None):
+    store = store if store else ForecastStore()
+    metrics = metrics if metrics else RunMetrics()
+
+    # every spot is scored in one batch, then split per category
+    with metrics.get_task("all", "sessions").timed(RunMetrics.STAGE_SCORE):
+        sessions = SurfScorer(store).get_sessions([ info for categ in categs for info in INFOS_MAP.get(categ, []) ])
+
+    hashes = store.get_all_hashes()
 
     for categ in categs:
         filepath = os.path.join(categ, "index.html")
-        filepath_tmp = filepath + ".tmp"
+        sessions_path = os.path.join(categ, SESSIONS_FILE)
+        names = set([ info.name for info in INFOS_MAP.get(categ, []) ])
+        categ_sessions = None if sessions is None else [ session for session in sessions if session['site'] in names ][:BEST_SESSIONS]
+
+        written = HtmlCreater(filepath, categ, metrics, store, categ_sessions, hashes).run()
+        content = json.dumps({ 'last_upd_tm': HtmlCreater.get_last_upd_tm() })
+        write_file_atomic(os.path.join(categ, LAST_UPD_FILE), content.encode('utf-8'))
 
-        HtmlCreater(filepath_tmp, categ).run()
-        shutil.move(filepath_tmp, filepath)
+        if written:
+            logging.info('File "%s" is updated.' % (filepath))
+        else:
+            logging.info('File "%s" is unchanged.' % (filepath))
+
+            if os.path.exists(sessions_path) or categ_sessions is None:
+                continue
 
-        logging.info('File "%s" is updated.' % (filepath))
+        if categ_sessions is not None:
+            content = json.dumps({ 'categ': categ, 'generated_at': int(time.time()), 'sessions': categ_sessions }, indent=1)
+            write_file_atomic(sessions_path, content.encode('utf-8'))
 
 
 if __name__ == "__main__":
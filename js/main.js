@@ -3,7 +3,6 @@ MIN_UPDATE_INTERVAL = 10;  /* 1 min */
 CGI_TIMEOUT = 30000;         /* 30 sec */
 WEATHER_BUTTON_TXT_SHOW = "Show Weather";
 WEATHER_BUTTON_TXT_HIDE = "Hide Weather";
-TW_SITE_ARRAY = [ "twn", "twe" ];
 
 String.format = function() {
   var s = arguments[0];
@@ -20,17 +19,72 @@ function Main() {
 	loadingIcon = $("#loading-icon");
 	mask = $("#mask");
 	siteCateg = $("#site-categ").text();
+	twSites = $("#tw-categs").text().split(" "); /* categories of region "tw" in spots.json */
 
-	var last_upd_tm = $(".last_upd_tm");
+	ShowLastUpdTm(parseInt($(".last_upd_tm").text()));
 
-	lastUpdTm = parseInt(last_upd_tm.text()); /* UTC time */
-	last_upd_tm.text(String.format("[{0}] - Last Update: {1}",
-								   siteCateg, GetTimeStr(lastUpdTm)));
-	last_upd_tm.show()
+	/* an unchanged page is not rewritten, the time of the last update is kept next to it */
+	$.ajax({
+		url: "/" + siteCateg + "/last_upd.json",
+		dataType: "json",
+		cache: false,
+		success: function(data) { ShowLastUpdTm(data.last_upd_tm); }
+	});
 
 	$("#next_btn").attr("title", GetNextSite()).click(OnNextBtnClick);
 	$("#upd_btn").click(OnUpdBtnClick);
 	$("#weather_btn").click(OnWeatherBtnClick);
+
+	InitCharts();
+}
+
+function InitCharts() {
+	charts = $("#jp_chart").data("charts") || []; /* newest first */
+	chartIdx = 0;
+
+	if (charts.length < 2) {
+		return;
+	}
+
+	$("#chart_prev_btn").click(function() { ShowChart(chartIdx + 1); });
+	$("#chart_next_btn").click(function() { ShowChart(chartIdx - 1); });
+	$(".chart-nav").show();
+
+	ShowChart(0);
+}
+
+function ShowChart(idx) {
+	if (idx < 0 || idx >= charts.length) {
+		return;
+	}
+
+	var chart = charts[idx];
+	var source = $("#jp_chart source");
+
+	chartIdx = idx;
+
+	if (chart.webp) {
+		if (0 === source.length) {
+			source = $('<source type="image/webp"/>').prependTo("#jp_chart");
+		}
+		source.attr("srcset", chart.webp);
+	} else {
+		source.remove();
+	}
+
+	$("#jp_img").attr("src", chart.gif);
+	$("#chart_tm").text(new Date(chart.time*1000).toString());
+	$("#chart_prev_btn").prop("disabled", charts.length - 1 === idx);
+	$("#chart_next_btn").prop("disabled", 0 === idx);
+}
+
+function ShowLastUpdTm(tm) {
+	var last_upd_tm = $(".last_upd_tm");
+
+	lastUpdTm = tm; /* UTC time */
+	last_upd_tm.text(String.format("[{0}] - Last Update: {1}",
+								   siteCateg, GetTimeStr(lastUpdTm)));
+	last_upd_tm.show()
 }
 
 function GetUTCTime() {
@@ -68,7 +122,7 @@ function CheckLastUpdateTime() {
 }
 
 function GetNextSite() {
-	var sites = TW_SITE_ARRAY;
+	var sites = twSites;
 	var idx = sites.indexOf(siteCateg);
 
 	if (sites.length === ++idx) {